@@ -6,63 +6,250 @@ import sklearn.preprocessing as pre
 import streamlit as st
 
 import queries
-
-
-def percent_to_population(feature: str, name: str, df: pd.DataFrame) -> pd.DataFrame:
-    pd.set_option('mode.chained_assignment', None)
-    df[name] = (df.loc[:, feature].astype(float) / 100) * df.loc[:, 'Total Population'].astype(float) * 1000
-    return df
-
-
-def cross_features(df: pd.DataFrame) -> pd.DataFrame:
-    cols = ['Pop Below Poverty Level', 'Pop Unemployed', 'Income Inequality (Ratio)', 'Non-Home Ownership Pop',
-            'Num Burdened Households', 'Num Single Parent Households']
-    all_combinations = []
-    for r in range(2, 3):
-        combinations_list = list(itertools.combinations(cols, r))
-        all_combinations += combinations_list
-    new_cols = []
-    for combo in all_combinations:
-        new_cols.append(cross(combo, df))
-
-    crossed_df = pd.DataFrame(new_cols)
-    crossed_df = crossed_df.T
+import utils
+from constants import STATES
+
+
+def percent_to_population(features: list, names: list, df: pd.DataFrame) -> pd.DataFrame:
+    population = df['Total Population'].astype(float).to_numpy()[:, None]
+    values = (df[features].astype(float).to_numpy() / 100) * population * 1000
+    return pd.DataFrame(values, index=df.index, columns=names)
+
+
+CROSS_FEATURES = ['Pop Below Poverty Level', 'Pop Unemployed', 'Income Inequality (Ratio)', 'Non-Home Ownership Pop',
+                  'Num Burdened Households', 'Num Single Parent Households']
+
+
+def cross_features(df: pd.DataFrame, cols: list = None, order: int = 2,
+                   max_bytes: int = 64 * 1024 ** 2) -> pd.DataFrame:
+    """Crosses features by multiplying every combination of 2 up to `order` columns.
+    in:  dataframe, columns to cross (defaults to CROSS_FEATURES), highest order of combination,
+         memory budget for each block of products
+    out: dataframe of absolute crossed products named like 'a_X_b', and their row-wise 'Mean'
+    """
+    if cols is None:
+        cols = CROSS_FEATURES
+    values = df[cols].to_numpy(dtype='float64')
+    # Missing values are skipped in a product, the same as DataFrame.product
+    values = np.where(np.isnan(values), 1, values)
+
+    names = []
+    blocks = []
+    for r in range(2, order + 1):
+        combos = np.array(list(itertools.combinations(range(len(cols)), r)), dtype=np.int64).reshape(-1, r)
+        step = max(1, max_bytes // (8 * r * max(len(values), 1)))
+        for start in range(0, len(combos), step):
+            blocks.append(np.abs(values[:, combos[start:start + step]].prod(axis=2)))
+        names += ['_X_'.join(cols[i] for i in combo) for combo in combos]
+
+    products = np.hstack(blocks) if blocks else np.empty((len(values), 0))
+    crossed_df = pd.DataFrame(products, index=df.index, columns=names)
     crossed_df['Mean'] = crossed_df.mean(axis=1)
 
     return crossed_df
 
 
 def prepare_analysis_data(df: pd.DataFrame) -> pd.DataFrame:
-    temp_df=df.copy()
     cols_to_drop = ['Population Below Poverty Line (%)',
                     'Unemployment Rate (%)',
                     'Burdened Households (%)',
                     'Single Parent Households (%)',
                     'Non-White Population (%)',
+                    'Policy Value',
+                    'Countdown'
                     ]
-    for col in list(temp_df.columns):
-        if '(%)' in col:
-            if col == 'Unemployment Rate (%)':
-                temp_df = percent_to_population('Unemployment Rate (%)', 'Population Unemployed', temp_df)
-            else:
-                temp_df = percent_to_population(col, col.replace(' (%)', ''), temp_df)
-
-    if 'Policy Value' in list(temp_df.columns) or 'Countdown' in list(temp_df.columns):
-        temp_df = temp_df.drop(['Policy Value', 'Countdown'], axis=1)
-
-    for col in cols_to_drop:
-        try:
-            temp_df.drop([col], axis=1, inplace=True)
-        except:
-            pass
-    return temp_df
-
-
-def normalize(df: pd.DataFrame) -> pd.DataFrame:
-    scaler = pre.MaxAbsScaler()
-    df_scaled = pd.DataFrame(scaler.fit_transform(df), index=df.index, columns=df.columns)
-
-    return df_scaled
+    percent_cols = [col for col in df.columns if '(%)' in col]
+    temp_df = df
+    if percent_cols:
+        names = ['Population Unemployed' if col == 'Unemployment Rate (%)' else col.replace(' (%)', '')
+                 for col in percent_cols]
+        temp_df = pd.concat([df.drop(names, axis=1, errors='ignore'),
+                             percent_to_population(percent_cols, names, df)], axis=1)
+
+    return temp_df.drop(cols_to_drop, axis=1, errors='ignore')
+
+
+class CorrelationMatrix(object):
+    """Pairwise-complete Pearson correlations built from sufficient statistics (pair counts, sums, sums of squares and
+    cross products). Statistics are only computed for columns that have been requested, and requesting more columns
+    only computes the blocks for the new columns.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.data = df
+        self.columns = []
+        self._values = np.empty((len(df), 0))
+        self._present = np.empty((len(df), 0))
+        self._stats = {name: np.empty((0, 0)) for name in ('count', 'sum', 'square', 'product')}
+
+    def add_columns(self, columns: list):
+        new_columns = [c for c in columns if c not in self.columns]
+        if not new_columns:
+            return
+        values = self.data[new_columns].to_numpy(dtype='float64')
+        present = np.isfinite(values).astype('float64')
+        # Correlation does not change when a column is shifted, so columns are centered to keep the sums small
+        values = np.where(present > 0, values - np.nanmean(values, axis=0), 0.0)
+
+        all_values = np.hstack([self._values, values])
+        all_present = np.hstack([self._present, present])
+        operands = {
+            'count': (all_present, all_present, present, present),
+            'sum': (all_values, all_present, values, present),
+            'square': (all_values ** 2, all_present, values ** 2, present),
+            'product': (all_values, all_values, values, values),
+        }
+        k = len(self.columns)
+        for name, (left, right, left_new, right_new) in operands.items():
+            stat = np.zeros((k + len(new_columns),) * 2)
+            stat[:k, :k] = self._stats[name]
+            stat[:, k:] = left.T @ right_new
+            stat[k:, :] = left_new.T @ right
+            self._stats[name] = stat
+
+        self.columns += new_columns
+        self._values, self._present = all_values, all_present
+
+    def corr(self, columns: list) -> pd.DataFrame:
+        self.add_columns(columns)
+        idx = np.ix_(*[[self.columns.index(c) for c in columns]] * 2)
+        count, sums = self._stats['count'][idx], self._stats['sum'][idx]
+        squares, products = self._stats['square'][idx], self._stats['product'][idx]
+
+        spread = count * squares - sums ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = (count * products - sums * sums.T) / np.sqrt(spread * spread.T)
+        corr = np.clip(corr, -1, 1)
+        return pd.DataFrame(corr, index=columns, columns=columns)
+
+
+@st.experimental_memo(ttl=1200)
+def _index_matrix(frames: tuple, indicators: tuple) -> tuple:
+    combined = frames[0]
+    for frame in frames[1:]:
+        combined = combined.merge(frame, how='outer', on='Census Tract', suffixes=('', '_DROP')).filter(
+            regex='^(?!.*_DROP)')
+    # Missing indicator values contribute nothing to a tract's index
+    matrix = np.nan_to_num(combined[list(indicators)].to_numpy(dtype='float64'))
+    return combined['Census Tract'].to_numpy(), matrix
+
+
+def index_matrix(frames: list, indicators: list) -> tuple:
+    """Combines normalized census tract frames into a tract x indicator matrix.
+    in:  normalized frames keyed on 'Census Tract', earlier frames taking precedence, selected indicators
+    out: array of census tracts, float matrix of shape (tracts, indicators)
+    """
+    frames = tuple(frame[['Census Tract'] + [x for x in indicators if x in frame.columns]] for frame in frames)
+    return _index_matrix(frames, tuple(indicators))
+
+
+def index_weights(weights: dict, indicators: list) -> np.ndarray:
+    return np.array([weights[x] for x in indicators], dtype='float64')
+
+
+def vulnerability_index(tracts: np.ndarray, matrix: np.ndarray, weights: np.ndarray) -> pd.Series:
+    index = pd.Series(matrix @ weights, index=tracts, name='Index Value')
+    if not index.index.is_unique:
+        index = index.groupby(level=0).sum()
+    return index
+
+
+def index_contributions(tracts: np.ndarray, matrix: np.ndarray, weights: np.ndarray, indicators: list) -> pd.DataFrame:
+    return pd.DataFrame({
+        'Census Tract': np.tile(tracts, len(indicators)),
+        'Indicators': np.repeat(indicators, len(tracts)),
+        'Index Value': (matrix * weights).T.ravel()
+    })
+
+
+def top_values(series: pd.Series, n: int) -> pd.Series:
+    values = series.to_numpy()
+    n = min(n, len(values))
+    if n < 1:
+        return series.iloc[:0]
+    top = np.argpartition(-values, n - 1)[:n]
+    return series.iloc[top[np.argsort(-values[top], kind='stable')]]
+
+
+def weight_grid_size(n_indicators: int, step: int) -> int:
+    units = 100 // step
+    return math.factorial(units + n_indicators - 1) // (
+            math.factorial(n_indicators - 1) * math.factorial(units))
+
+
+def weight_samples(n_indicators: int, method: str = 'random', samples: int = 1000, step: int = 10,
+                   seed: int = 0, max_samples: int = 50000) -> np.ndarray:
+    """Generates indicator weight vectors summing to 100.
+    in:  number of indicators, 'random' (uniform over all weightings) or 'grid' (every weighting in multiples of step)
+    out: array of shape (samples, n_indicators)
+    """
+    if method == 'random':
+        return np.random.default_rng(seed).dirichlet(np.ones(n_indicators), size=samples) * 100
+    elif method == 'grid':
+        size = weight_grid_size(n_indicators, step)
+        if size > max_samples:
+            raise ValueError(f'A {step}% grid over {n_indicators} indicators has {size} weightings, '
+                             f'more than the limit of {max_samples}. Increase the step or use random weights.')
+        # Stars and bars: each choice of divider positions splits the units between the indicators
+        units = 100 // step
+        dividers = np.array(list(itertools.combinations(range(units + n_indicators - 1), n_indicators - 1)),
+                            dtype=np.int64).reshape(size, n_indicators - 1)
+        bounds = np.hstack([np.full((size, 1), -1), dividers, np.full((size, 1), units + n_indicators - 1)])
+        return (np.diff(bounds, axis=1) - 1) * (100 / units)
+    raise ValueError(f'Unknown weight sampling method: {method}')
+
+
+@st.experimental_memo(ttl=1200, max_entries=8)
+def weight_sensitivity(tracts: np.ndarray, matrix: np.ndarray, weights: np.ndarray, top_n: int = 10,
+                       max_bytes: int = 64 * 1024 ** 2) -> pd.DataFrame:
+    """Ranks the census tracts under every weight vector and summarizes how stable each tract's rank is.
+    in:  census tracts, tract x indicator matrix from index_matrix, weight vectors from weight_samples,
+         rank cutoff, memory budget for a batch of scores and ranks
+    out: dataframe of rank statistics indexed by census tract, ordered by mean rank
+    """
+    n_tracts = len(tracts)
+    n_samples = len(weights)
+    batch_size = max(1, min(n_samples, max_bytes // (3 * 8 * max(n_tracts, 1))))
+    positions = np.arange(1, n_tracts + 1, dtype=np.int64)[:, None]
+
+    rank_sum = np.zeros(n_tracts)
+    rank_squares = np.zeros(n_tracts)
+    best = np.full(n_tracts, n_tracts, dtype=np.int64)
+    worst = np.zeros(n_tracts, dtype=np.int64)
+    top_count = np.zeros(n_tracts, dtype=np.int64)
+    for start in range(0, n_samples, batch_size):
+        scores = matrix @ weights[start:start + batch_size].T
+        order = np.argsort(-scores, axis=0, kind='stable')
+        ranks = np.empty(order.shape, dtype=np.int64)
+        np.put_along_axis(ranks, order, positions, axis=0)
+        rank_sum += ranks.sum(axis=1)
+        rank_squares += (ranks.astype('float64') ** 2).sum(axis=1)
+        best = np.minimum(best, ranks.min(axis=1))
+        worst = np.maximum(worst, ranks.max(axis=1))
+        top_count += (ranks <= top_n).sum(axis=1)
+
+    mean_rank = rank_sum / n_samples
+    result = pd.DataFrame({
+        'Mean Rank': mean_rank,
+        'Rank Std': np.sqrt(np.maximum(rank_squares / n_samples - mean_rank ** 2, 0)),
+        'Best Rank': best,
+        'Worst Rank': worst,
+        f'Top {top_n} (%)': 100 * top_count / n_samples
+    }, index=pd.Index(tracts, name='Census Tract'))
+    return result.sort_values('Mean Rank')
+
+
+def max_abs(df: pd.DataFrame) -> pd.Series:
+    # Per-column scale used by normalize, 1 where a column is all zero or missing (as MaxAbsScaler does)
+    scale = df.abs().max()
+    return scale.where(scale > 0, 1)
+
+
+def normalize(df: pd.DataFrame, scale: pd.Series = None) -> pd.DataFrame:
+    # Max-abs normalization; pass a scale to normalize a partition by statistics of the whole dataset
+    if scale is None:
+        scale = max_abs(df)
+    return df / scale
 
 
 def normalize_column(df: pd.DataFrame, col: str) -> pd.DataFrame:
@@ -83,67 +270,216 @@ def cross(columns: tuple, df: pd.DataFrame) -> pd.Series:
     return new_series
 
 
-def priority_indicator(socioeconomic_index: float, policy_index: float, time_left: int = 1) -> float:
-    if time_left < 1:
-        # Handle 0 values
-        time_left = 1
+def priority_indicator(socioeconomic_index: np.ndarray, policy_index: np.ndarray,
+                       time_left: np.ndarray = 1) -> np.ndarray:
+    # Handle 0 values: anything under a month left is treated as one
+    time_left = np.maximum(time_left, 1)
 
-    return float(socioeconomic_index) * (1 - float(policy_index)) / math.sqrt(time_left)
+    return socioeconomic_index * (1 - policy_index) / np.sqrt(time_left)
 
 
-def rank_counties(df: pd.DataFrame, label: str) -> pd.DataFrame:
-    analysis_df = prepare_analysis_data(df)
-    analysis_df = normalize(analysis_df)
+def partial_features(df: pd.DataFrame) -> tuple:
+    """Derives the analysis features of one partition of a dataset along with the statistics normalization needs,
+    so partitions can be prepared in parallel and merged with merge_features.
+    in:  county dataframe for a partition (e.g. a shard of states)
+    out: unnormalized analysis features, their max-abs scale, numeric source columns
+    """
+    numeric = df.select_dtypes('number')
+    prepared = prepare_analysis_data(numeric)
+    return prepared, prepared.abs().max(), list(numeric.columns)
 
-    # crossed = cross_features(analysis_df)
-    # analysis_df['Crossed'] = crossed['Mean']
-    # analysis_df = normalize_column(analysis_df, 'Crossed')
 
-    analysis_df['Relative Risk'] = analysis_df.sum(axis=1)
-    max_sum = analysis_df['Relative Risk'].max()
-    analysis_df['Relative Risk'] = (analysis_df['Relative Risk'] / max_sum)
+def merge_features(partials: list) -> tuple:
+    """Combines partial_features results, normalizing every partition by the maximum across all of them.
+    in:  list of partial_features results
+    out: normalized analysis features, dict of each source column to the analysis features derived from it
+    """
+    analysis_df = pd.concat([p[0] for p in partials])
+    scale = pd.concat([p[1] for p in partials], axis=1).max(axis=1)
+    analysis_df = normalize(analysis_df, scale.where(scale > 0, 1))
 
-    if 'Policy Value' in list(df.columns):
+    sources = {}
+    for col in dict.fromkeys(c for p in partials for c in p[2]):
+        derived = []
+        if '(%)' in col:
+            derived.append('Population Unemployed' if col == 'Unemployment Rate (%)' else col.replace(' (%)', ''))
+        derived.append(col)
+        sources[col] = [x for x in derived if x in analysis_df.columns]
+    return analysis_df, sources
+
+
+@st.experimental_memo(ttl=1200)
+def normalized_features(df: pd.DataFrame) -> tuple:
+    """Prepares and max-abs normalizes every numeric feature of a dataset once, so Relative Risk can be
+    recomputed for any subset of features without renormalizing.
+    in:  county dataframe
+    out: normalized analysis features, dict of each source column to the analysis features derived from it
+    """
+    return merge_features([partial_features(df)])
+
+
+def national_shard(states: list) -> tuple:
+    df = queries.national_shard(states)
+    return df, partial_features(df)
+
+
+@st.experimental_memo(ttl=3600)
+def national_features(workers: int = None) -> tuple:
+    """Fetches, cleans and derives features for every county in the US across worker processes, one shard of states
+    each, then normalizes them by the national maxima. The workers don't share the per-state get_county_data memo,
+    so the whole result is memoized here.
+    in:  number of worker processes (one per core by default)
+    out: county dataframe, normalized features and sources as from normalized_features
+    """
+    shards = list(utils.map_partitioned(national_shard, STATES, workers))
+    return pd.concat([df for df, _ in shards]), merge_features([p for _, p in shards])
+
+
+def relative_risk(normalized: pd.DataFrame, features: list) -> pd.Series:
+    risk = normalized[features].sum(axis=1)
+    return risk / risk.max()
+
+
+def rank_counties(df: pd.DataFrame, columns: list = None, crossed: bool = False,
+                  precomputed: tuple = None) -> pd.DataFrame:
+    # precomputed takes normalized_features / merge_features output, e.g. from a partitioned national run
+    normalized, sources = precomputed if precomputed is not None else normalized_features(df)
+    if columns is None:
+        # Sources cover every feature even when df only holds the Policy Value and Countdown columns
+        columns = list(dict.fromkeys(list(sources) + list(df.columns)))
+    selected = set(x for col in columns for x in sources.get(col, []))
+    features = [col for col in normalized.columns if col in selected]
+
+    analysis_df = normalized[features].copy()
+    if crossed:
+        analysis_df['Crossed'] = cross_features(analysis_df, features)['Mean']
+        analysis_df = normalize_column(analysis_df, 'Crossed')
+
+    analysis_df['Relative Risk'] = relative_risk(analysis_df, list(analysis_df.columns))
+
+    if 'Policy Value' in columns:
         analysis_df['Policy Value'] = df['Policy Value']
         analysis_df['Countdown'] = df['Countdown']
-        analysis_df['Rank'] = analysis_df.apply(
-            lambda x: priority_indicator(x['Relative Risk'], x['Policy Value'], x['Countdown']), axis=1
-        )
-
-    analysis_df.to_excel('Output/' + label + '_overall_vulnerability.xlsx')
+        analysis_df['Rank'] = priority_indicator(analysis_df['Relative Risk'].to_numpy(dtype='float64'),
+                                                 analysis_df['Policy Value'].to_numpy(dtype='float64'),
+                                                 analysis_df['Countdown'].to_numpy(dtype='float64'))
 
     return analysis_df
 
 
-def calculate_cost_estimate(df: pd.DataFrame, pct_burdened: float, distribution: dict,
-                            rent_type: str = 'fmr') -> pd.DataFrame:
-    if rent_type == 'fmr':
-        cost_df = queries.static_data_single_table('fair_market_rents_new', queries.STATIC_COLUMNS['fair_market_rents'])
-    elif rent_type == 'rent50':
-        cost_df = queries.static_data_single_table('median_rents_new', queries.STATIC_COLUMNS['median_rents'])
+def relative_risk_over_time(values: np.ndarray) -> np.ndarray:
+    """Computes Relative Risk for every time step at once, the same way rank_counties does for the latest values.
+    in:  county x date x indicator array (queries.fred_time_series)
+    out: county x date array of Relative Risk, NaN where a county has no data for a date
+    """
+    # Max-abs normalize each indicator within each date; fmax ignores missing values without warnings
+    scale = np.fmax.reduce(np.abs(values), axis=0)
+    scale[~(scale > 0)] = 1
+    risk = np.nansum(values / scale, axis=2)
+    risk[np.isnan(values).all(axis=2)] = np.nan
+    max_risk = np.fmax.reduce(risk, axis=0)
+    max_risk[~(max_risk != 0)] = 1
+    return risk / max_risk
+
 
+def risk_trend(series: dict) -> pd.DataFrame:
+    risk = relative_risk_over_time(series['values'])
+    return pd.DataFrame({
+        'county_id': np.repeat(series['county_id'], len(series['date'])),
+        'date': np.tile(series['date'], len(series['county_id'])),
+        'Relative Risk': risk.ravel()
+    }).dropna()
 
-    df = df.reset_index().merge(cost_df, how="left", on='county_id').set_index(['State', 'County Name'])
 
-    df['br_cost_0'] = distribution[0] * df[f'{rent_type}_0'] * (df['Renter Occupied Units']) * (df['burdened_households'] / 100) * (pct_burdened / 100)
-    df['br_cost_1'] = distribution[1] * df[f'{rent_type}_1'] * (df['Renter Occupied Units']) * (df['burdened_households'] / 100) * (pct_burdened / 100)
-    df['br_cost_2'] = distribution[2] * df[f'{rent_type}_2'] * (df['Renter Occupied Units']) * (df['burdened_households'] / 100) * (pct_burdened / 100)
-    df['br_cost_3'] = distribution[3] * df[f'{rent_type}_3'] * (df['Renter Occupied Units']) * (df['burdened_households'] / 100) * (pct_burdened / 100)
-    df['br_cost_4'] = distribution[4] * df[f'{rent_type}_4'] * (df['Renter Occupied Units']) * (df['burdened_households'] / 100) * (pct_burdened / 100)
-    df['total_cost'] = np.sum([df['br_cost_0'], df['br_cost_1'], df['br_cost_2'], df['br_cost_3'], df['br_cost_4']], axis=0)
+def export_rankings(analysis_df: pd.DataFrame, label: str, file_format: str = 'xlsx') -> str:
+    file_format = utils.export_format(analysis_df, file_format)
+    path = utils.export_file_name('Output/' + label + '_overall_vulnerability', file_format)
+    utils.write_export(analysis_df, path, file_format)
+    return path
+
+
+RENT_TYPES = {'Fair Market': 'fmr', 'Median': 'rent50'}
+
+BEDROOMS = range(5)
+
+
+def distribution_matrix(metro_areas: pd.DataFrame) -> np.ndarray:
+    # locations x bedrooms housing stock distribution from queries.load_distributions
+    return metro_areas[[f'{i}_br_pct' for i in BEDROOMS]].to_numpy(dtype='float64')
+
+
+def burdened_renters(df: pd.DataFrame) -> np.ndarray:
+    return df['Renter Occupied Units'].to_numpy(dtype='float64') * (
+            df['burdened_households'].to_numpy(dtype='float64') / 100)
+
+
+def rent_matrix(df: pd.DataFrame, rent_type: str) -> pd.DataFrame:
+    cost_df = queries.rent_table(rent_type)
+    return df.reset_index().merge(cost_df, how="left", on='county_id').set_index(['State', 'County Name'])
+
+
+def location_distribution(metro_areas: pd.DataFrame, location: str = None) -> dict:
+    # Bedroom -> share of housing stock for a location, defaulting to the first one in the table
+    if location is None:
+        location = metro_areas.index[0]
+    return {i: float(metro_areas.loc[location, f'{i}_br_pct']) for i in BEDROOMS}
+
+
+def calculate_cost_estimate(df: pd.DataFrame, pct_burdened: float, distribution: dict,
+                            rent_type: str = 'fmr') -> pd.DataFrame:
+    df = rent_matrix(df, rent_type)
+
+    rents = df[[f'{rent_type}_{i}' for i in BEDROOMS]].to_numpy(dtype='float64')
+    weights = np.array([distribution[i] for i in BEDROOMS], dtype='float64')
+    costs = rents * weights * (burdened_renters(df) * (pct_burdened / 100))[:, None]
+    for i in BEDROOMS:
+        df[f'br_cost_{i}'] = costs[:, i]
+    df['total_cost'] = costs.sum(axis=1)
     return df
 
 
+@st.experimental_memo(ttl=1200)
+def cost_scenarios(df: pd.DataFrame, metro_areas: pd.DataFrame, pct_burdened: tuple = tuple(range(0, 101, 10)),
+                   rent_types: tuple = tuple(RENT_TYPES), by_county: bool = False) -> pd.DataFrame:
+    """Estimates the cost to avoid evictions for every combination of housing stock distribution,
+    percent of the burdened population supported and rent type.
+    in:  county dataframe, distributions indexed by location, percents to sweep, rent types (keys of RENT_TYPES),
+         whether to keep a row per county instead of totalling the counties
+    out: tidy dataframe with a 'total_cost' per scenario (and county)
+    """
+    distributions = distribution_matrix(metro_areas)
+    pcts = np.array(pct_burdened, dtype='float64')
+    locations = np.asarray(metro_areas.index)
+    frames = []
+    for rent_label in rent_types:
+        rent_type = RENT_TYPES[rent_label]
+        cost_df = rent_matrix(df, rent_type)
+        rents = cost_df[[f'{rent_type}_{i}' for i in BEDROOMS]].to_numpy(dtype='float64')
+        # counties x locations cost of supporting every burdened renter
+        base = (rents @ distributions.T) * burdened_renters(cost_df)[:, None]
+        if by_county:
+            costs = base[:, :, None] * (pcts / 100)
+            counties = cost_df.index.to_frame(index=False)
+            frame = counties.loc[np.repeat(np.arange(len(counties)), len(locations) * len(pcts))].reset_index(drop=True)
+            frame['Location'] = np.tile(np.repeat(locations, len(pcts)), len(counties))
+            frame['Percent Burdened'] = np.tile(pcts, len(counties) * len(locations))
+            frame['total_cost'] = costs.ravel()
+        else:
+            costs = np.nansum(base, axis=0)[:, None] * (pcts / 100)
+            frame = pd.DataFrame({
+                'Location': np.repeat(locations, len(pcts)),
+                'Percent Burdened': np.tile(pcts, len(locations)),
+                'total_cost': costs.ravel()
+            })
+        frame['Rent Type'] = rent_label
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
 def cost_of_evictions(df, metro_areas, locations):
     rent_type = st.selectbox('Rent Type', ['Fair Market', 'Median'])
     location = st.selectbox('Select a location to assume a housing distribution:', locations)
-    distribution = {
-        0: float(metro_areas.loc[location, '0_br_pct']),
-        1: float(metro_areas.loc[location, '1_br_pct']),
-        2: float(metro_areas.loc[location, '2_br_pct']),
-        3: float(metro_areas.loc[location, '3_br_pct']),
-        4: float(metro_areas.loc[location, '4_br_pct']),
-    }
+    distribution = location_distribution(metro_areas, location)
 
     pct_burdened = st.slider('Percent of Burdened Population to Support', 0, 100, value=50, step=1)
 
@@ -1,5 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 headers = {
     "Connection": "keep-alive",
@@ -13,37 +18,120 @@ headers = {
 
 
 def get_from_json(path: str) -> pd.DataFrame:
-    res = pd.read_json(path)
+    res = pd.read_json(open_source(path))
     res = pd.json_normalize(res)
     return res
 
 
 def get_from_excel(path: str, sheet_name: str = 'Sheet1') -> pd.DataFrame:
-    res = pd.read_excel(path, sheet_name=sheet_name)
+    res = pd.read_excel(open_source(path), sheet_name=sheet_name)
     return res
 
 
 def get_from_csv(path: str) -> pd.DataFrame:
-    res = pd.read_csv(path)
+    res = pd.read_csv(open_source(path))
     return res
 
 
-def get_http_data(url: str) -> pd.DataFrame:
-    res = requests.get(url, headers=headers)
-    if res.status_code == 200:
-        try:
-            if 'records' in res.json().keys():
-                res = pd.json_normalize(res.json()['records'])
-            else:
-                res = pd.json_normalize(res.json())
-            return res
-        except AttributeError:
-            return pd.json_normalize(res.json())
-    else:
-        print(res)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+
+
+def make_session(pool_size: int = 16, retries: int = 3, backoff: float = 0.5) -> requests.Session:
+    """Builds a session that keeps up to pool_size connections per host open and retries failed requests.
+    in:  connection pool size, number of retries, backoff factor (waits backoff * 2 ** (retry - 1) seconds)
+    out: requests session with the default headers
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+def is_url(path: str) -> bool:
+    return str(path).startswith(('http://', 'https://'))
+
+
+def open_source(path: str, session: requests.Session = None, timeout: float = 30):
+    # URLs are fetched through the pooled, retrying session instead of pandas' own unretried request
+    if not is_url(path):
+        return path
+    res = (session or get_session()).get(path, timeout=timeout)
+    res.raise_for_status()
+    return BytesIO(res.content)
+
+
+def records(payload) -> pd.DataFrame:
+    # Open data APIs either return a list of rows or wrap them in a 'records' key
+    if isinstance(payload, dict) and 'records' in payload:
+        payload = payload['records']
+    return pd.json_normalize(payload)
+
+
+def get_http_json(url: str, params: dict = None, session: requests.Session = None, timeout: float = 30):
+    session = session or get_session()
+    res = session.get(url, params=params, timeout=timeout)
+    res.raise_for_status()
+    return res.json()
+
+
+def get_http_data(url: str, params: dict = None, session: requests.Session = None,
+                  timeout: float = 30) -> pd.DataFrame:
+    try:
+        return records(get_http_json(url, params, session, timeout))
+    except requests.RequestException as e:
+        print(e)
         return pd.DataFrame()
 
 
+def get_many_http_data(urls: list, params: list = None, session: requests.Session = None, workers: int = 8,
+                       timeout: float = 30) -> pd.DataFrame:
+    """Fetches several URLs (or one URL with several sets of query parameters) concurrently over a shared session.
+    in:  urls, optional query parameters per url, session, number of concurrent requests, timeout per request
+    out: rows of every response, in the order of urls
+    """
+    session = session or get_session()
+    params = params or [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(lambda args: records(get_http_json(*args, session, timeout)), zip(urls, params)))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def get_paged_http_data(url: str, page_size: int = 1000, offset_param: str = 'offset', limit_param: str = 'limit',
+                        params: dict = None, session: requests.Session = None, workers: int = 8,
+                        timeout: float = 30, max_pages: int = None) -> pd.DataFrame:
+    """Fetches an offset-paginated API (e.g. Socrata's $offset/$limit) a batch of pages at a time, stopping at the
+    first page with fewer than page_size rows.
+    in:  url, rows per page, names of the offset and limit parameters, other query parameters, session,
+         pages fetched concurrently, timeout per request, optional page limit
+    out: rows of every page, in order
+    """
+    session = session or get_session()
+    frames = []
+    page = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while max_pages is None or page < max_pages:
+            batch = range(page, page + workers if max_pages is None else min(page + workers, max_pages))
+            pages = [{**(params or {}), offset_param: i * page_size, limit_param: page_size} for i in batch]
+            results = list(executor.map(lambda p: records(get_http_json(url, p, session, timeout)), pages))
+            frames += [r for r in results if not r.empty]
+            page += len(batch)
+            if any(len(r) < page_size for r in results):
+                break
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
 if __name__ == '__main__':
     # df = get_http_data()
     # print(df.head())
@@ -0,0 +1,56 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from constants import BREAKS, COLOR_RANGE
+
+SCHEMES = ['equal_interval', 'quantile', 'categorical']
+
+PALETTE = np.array([color + [255] for color in COLOR_RANGE], dtype=np.uint8)
+
+
+def fingerprint(values: np.ndarray) -> str:
+    return hashlib.md5(pd.util.hash_array(values).tobytes()).hexdigest()
+
+
+@st.experimental_memo(max_entries=64)
+def class_breaks(feature: str, scheme: str, key: str, _values: np.ndarray) -> np.ndarray:
+    # Cached on (feature, scheme, fingerprint of the values); `_values` is left out of the hash
+    finite = _values[np.isfinite(_values)]
+    if len(finite) == 0:
+        return np.zeros(len(BREAKS))
+    if scheme == 'quantile':
+        return np.quantile(finite, BREAKS)
+    elif scheme == 'equal_interval':
+        return finite.min() + (finite.max() - finite.min()) * np.array(BREAKS)
+    raise ValueError(f'Unknown classification scheme: {scheme}')
+
+
+def class_indices(values: pd.Series, scheme: str = None, feature: str = None) -> np.ndarray:
+    if scheme is None:
+        scheme = 'equal_interval' if pd.api.types.is_numeric_dtype(values) else 'categorical'
+
+    if scheme == 'categorical':
+        # Categories are enumerated in order of appearance, cycling through the first 10 colors
+        codes, uniques = pd.factorize(values)
+        codes[codes < 0] = len(uniques)
+        return codes % (len(BREAKS) - 1)
+
+    numeric = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64')
+    breaks = class_breaks(feature if feature else str(values.name), scheme, fingerprint(numeric), numeric)
+    # Values above the last break, or missing, take the last color
+    return np.minimum(np.searchsorted(breaks, numeric, side='left'), len(PALETTE) - 1)
+
+
+def fill_colors(values: pd.Series, scheme: str = None, feature: str = None, override: dict = None) -> np.ndarray:
+    """Classifies a feature and returns an RGBA color for each value.
+    in:  feature values, classification scheme (one of SCHEMES, inferred from the dtype when not given),
+         feature name used to cache breaks, optional mapping of specific values to fixed RGBA colors
+    out: uint8 array of shape (len(values), 4)
+    """
+    colors = PALETTE[class_indices(values, scheme, feature)]
+    if override:
+        for value, color in override.items():
+            colors[(values == value).to_numpy()] = color
+    return colors
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import analysis
+import queries
+import utils
+from constants import STATES, EQUITY_CONCENTRATIONS
+
+COMMANDS = ['county', 'counties', 'state', 'national', 'equity', 'export']
+
+
+def output_path(output_dir: str, name: str, file_format: str) -> str:
+    return utils.export_file_name(os.path.join(output_dir, name), file_format)
+
+
+COST_DEFAULTS = {'pct_burdened': 50, 'rent_type': 'fmr', 'distribution': None}
+
+# The only county columns rank_counties reads besides the precomputed features
+PRIORITY_COLUMNS = ['Policy Value', 'Countdown']
+
+
+def estimate_cost(df: pd.DataFrame, options: dict) -> pd.DataFrame:
+    options = {**COST_DEFAULTS, **{k: v for k, v in options.items() if v is not None}}
+    metro_areas, _ = queries.load_distributions()
+    distribution = analysis.location_distribution(metro_areas, options['distribution'])
+    return analysis.calculate_cost_estimate(df, options['pct_burdened'], distribution,
+                                            rent_type=options['rent_type'])
+
+
+def write_rankings(df: pd.DataFrame, name: str, job: dict, features: tuple = None) -> list:
+    analysis_df = analysis.rank_counties(df, precomputed=features)
+    path = output_path(job['output_dir'], name + '_overall_vulnerability', job['format'])
+    utils.output_table(analysis_df, path, job['format'])
+    return [path]
+
+
+def run_counties(job: dict) -> tuple:
+    state = job['state']
+    counties = [c.strip().lower() for c in job['counties']]
+    df = queries.get_county_data(state, counties)
+    if job.get('cost'):
+        df = estimate_cost(df, job)
+
+    name = counties[0].capitalize() if job['command'] == 'county' else state + '_selected_counties'
+    path = output_path(job['output_dir'], name, job['format'])
+    utils.output_table(df, path, job['format'])
+    outputs = [path]
+    if len(df) > 1:
+        outputs += write_rankings(df, name, job)
+    return len(df), outputs
+
+
+def run_state(job: dict) -> tuple:
+    state = job['state']
+    df = queries.get_county_data(state)
+    if job.get('cost'):
+        df = estimate_cost(df, job)
+
+    path = output_path(job['output_dir'], state, job['format'])
+    utils.output_table(df, path, job['format'])
+    return len(df), [path] + write_rankings(df, state, job)
+
+
+def national_shard(states: list, cost: dict = None) -> tuple:
+    df = queries.national_shard(states)
+    if cost is not None:
+        df = estimate_cost(df, cost)
+    return df.loc[:, ~df.columns.str.contains('^Unnamed')], analysis.partial_features(df)
+
+
+def stream_national(path: str, file_format: str, states: list = None, cost: dict = None,
+                    workers: int = None) -> tuple:
+    """Writes every county in the US to one file. Shards of states are fetched in parallel worker processes and
+    written in order as they finish; only their analysis features are kept in memory.
+    in:  output path, format, states to include (all by default), cost estimate options or None to skip it,
+         number of worker processes (one per core by default)
+    out: the PRIORITY_COLUMNS of every county that has them (one row per county), features normalized across all
+         shards for rank_counties
+    """
+    frames, partials = [], []
+    with utils.StreamingExport(path, file_format) as writer:
+        for df, partial in utils.map_partitioned(national_shard, states or STATES, workers, cost=cost):
+            writer.write(df)
+            frames.append(df[[c for c in PRIORITY_COLUMNS if c in df.columns]])
+            partials.append(partial)
+    return pd.concat(frames), analysis.merge_features(partials)
+
+
+def run_national(job: dict) -> tuple:
+    path = output_path(job['output_dir'], 'US_national', job['format'])
+    cost = {k: job[k] for k in COST_DEFAULTS} if job.get('cost') else None
+    natl_df, features = stream_national(path, job['format'], job.get('states'), cost, job.get('workers'))
+    return len(natl_df), [path] + write_rankings(natl_df, 'US_national', job, features)
+
+
+def run_equity(job: dict) -> tuple:
+    state = job['state']
+    tables = sorted(t.strip().lower() for t in queries.EQUITY_CENSUS_TABLES)
+    df = queries.latest_data_census_tracts(state, job['counties'], tables)
+    df = df.loc[:, ~df.columns.duplicated()]
+    df['State'] = df['state_name']
+    df['County Name'] = df['county_name']
+    df.set_index(['State', 'County Name'], drop=True, inplace=True)
+    df = queries.clean_equity_data(df)
+    equity_df, _, _, _, _ = queries.get_equity_geographies(
+        df, EQUITY_CONCENTRATIONS[job.get('concentration', 'low').capitalize()])
+
+    path = output_path(job['output_dir'], state + '_equity_geographies', job['format'])
+    utils.output_table(equity_df, path, job['format'])
+    return len(equity_df), [path]
+
+
+def run_export(job: dict) -> tuple:
+    table = job['table']
+    df = queries.latest_data_single_table(table)
+    path = output_path(job['output_dir'], table, job['format'])
+    utils.output_table(df, path, job['format'])
+    return len(df), [path]
+
+
+RUNNERS = {
+    'county': run_counties,
+    'counties': run_counties,
+    'state': run_state,
+    'national': run_national,
+    'equity': run_equity,
+    'export': run_export,
+}
+
+
+def job_label(job: dict) -> str:
+    if job['command'] in ('county', 'counties', 'equity'):
+        return f"{job['command']}: {', '.join(job['counties'])}, {job['state']}"
+    elif job['command'] == 'state':
+        return f"state: {job['state']}"
+    elif job['command'] == 'export':
+        return f"export: {job['table']}"
+    return job['command']
+
+
+def run_job(job: dict) -> dict:
+    # Runs in a worker process, so failures are reported rather than raised
+    start = time.perf_counter()
+    result = {'Job': job_label(job), 'Rows': 0, 'Outputs': '', 'Seconds': 0.0, 'Error': ''}
+    try:
+        rows, outputs = RUNNERS[job['command']](job)
+        result.update({'Rows': rows, 'Outputs': ', '.join(outputs)})
+    except Exception as e:
+        result['Error'] = f'{type(e).__name__}: {e}'
+    result['Seconds'] = round(time.perf_counter() - start, 2)
+    return result
+
+
+def expand_jobs(args: argparse.Namespace) -> list:
+    """Turns parsed arguments, or every entry of a job file, into one job per geography or table.
+    in:  parsed arguments
+    out: list of job dicts, each with a 'command' and that command's options
+    """
+    defaults = {'format': args.format, 'output_dir': args.output_dir, 'workers': args.workers, 'cost': args.cost,
+                'pct_burdened': args.pct_burdened, 'rent_type': args.rent_type, 'distribution': args.distribution}
+    if args.jobs:
+        with open(args.jobs) as f:
+            entries = json.load(f)
+    else:
+        entries = [{k: v for k, v in vars(args).items() if v is not None}]
+
+    jobs = []
+    for entry in entries:
+        entry = {**defaults, **entry}
+        if entry['command'] == 'state':
+            states = entry.pop('states', None) or [entry.pop('state')]
+            jobs += [{**entry, 'state': state} for state in states]
+        elif entry['command'] == 'export':
+            tables = entry.pop('tables', None) or [entry.pop('table')]
+            jobs += [{**entry, 'table': table} for table in tables]
+        else:
+            if entry['command'] == 'county':
+                entry['counties'] = [entry.pop('county')] if 'county' in entry else entry['counties']
+            jobs.append(entry)
+    for job in jobs:
+        if job['command'] not in RUNNERS:
+            raise ValueError(f"Unknown command '{job['command']}'. Use one of: {', '.join(COMMANDS)}")
+        if job['format'] not in utils.EXPORT_FORMATS:
+            raise ValueError(f"Unknown format '{job['format']}'. Use one of: {', '.join(utils.EXPORT_FORMATS)}")
+    return jobs
+
+
+def run_jobs(jobs: list, workers: int = 1) -> pd.DataFrame:
+    results = []
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_job, job) for job in jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+                print(f"Finished {results[-1]['Job']} in {results[-1]['Seconds']}s")
+    else:
+        for job in jobs:
+            results.append(run_job(job))
+            print(f"Finished {results[-1]['Job']} in {results[-1]['Seconds']}s")
+    return pd.DataFrame(results)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Run Social Data analyses and exports without the Streamlit UI.')
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--format', default='xlsx', choices=list(utils.EXPORT_FORMATS), help='Output file format')
+    parser.add_argument('--output-dir', default='Output', help='Directory for output files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for multiple jobs, or for the states of a national job')
+    parser.add_argument('--jobs', help='JSON file listing jobs, e.g. [{"command": "state", "state": "Colorado"}]')
+    parser.add_argument('--cost', action='store_true', default=None,
+                        help='Estimate the cost to avoid evictions for county-level jobs')
+    parser.add_argument('--pct-burdened', type=float, default=50,
+                        help='Percent of the burdened population to support in cost estimates')
+    parser.add_argument('--rent-type', default='fmr', choices=list(analysis.RENT_TYPES.values()),
+                        help='Rent used in cost estimates')
+    parser.add_argument('--distribution', help='Housing stock distribution location used in cost estimates')
+
+    subparsers = parser.add_subparsers(dest='command')
+    county = subparsers.add_parser('county', help='Fetch a single county')
+    county.add_argument('state')
+    county.add_argument('county')
+    counties = subparsers.add_parser('counties', help='Fetch and rank several counties in a state')
+    counties.add_argument('state')
+    counties.add_argument('counties', nargs='+')
+    state = subparsers.add_parser('state', help='Fetch and rank all counties in one or more states')
+    state.add_argument('states', nargs='+')
+    national = subparsers.add_parser('national', help='Fetch and rank every county in the US')
+    national.add_argument('--states', nargs='+', help='Limit the national run to these states')
+    equity = subparsers.add_parser('equity', help='Find Equity Geographies among census tracts')
+    equity.add_argument('state')
+    equity.add_argument('counties', nargs='+')
+    equity.add_argument('--concentration', default='low', choices=[c.lower() for c in EQUITY_CONCENTRATIONS])
+    export = subparsers.add_parser('export', help='Export the latest values of one or more tables')
+    export.add_argument('tables', nargs='+')
+    return parser
+
+
+def main(argv: list = None) -> pd.DataFrame:
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None and args.jobs is None:
+        parser.error('a command or --jobs file is required')
+
+    jobs = expand_jobs(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for output_dir in set(job['output_dir'] for job in jobs):
+        os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    summary = run_jobs(jobs, args.workers)
+    print('*** Summary ***')
+    print(summary[['Job', 'Rows', 'Seconds', 'Error']].to_string(index=False))
+    print(f'{len(jobs)} job(s) finished in {round(time.perf_counter() - start, 2)}s with '
+          f"{(summary['Error'] != '').sum()} error(s)")
+    return summary
+
+
+if __name__ == '__main__':
+    summary = main()
+    sys.exit(1 if (summary['Error'] != '').any() else 0)
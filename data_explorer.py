@@ -36,7 +36,7 @@ def county_data_explorer():
             tmp_df = df.copy()
             st.caption(str(tmp_df.shape))
             st.dataframe(tmp_df)
-            st.download_button('Download raw data', utils.to_excel(df), file_name=f'{name}.xlsx')
+            utils.download_button('Download raw data', df, file_name=f'{name}.xlsx')
 
         st.write('''### View Feature''')
         temp = df.copy()
@@ -94,7 +94,7 @@ def census_data_explorer():
             st.caption(str(tmp_df.shape))
             tmp_df['geom'] = tmp_df['geom'].astype(str)
             st.dataframe(tmp_df)
-            st.download_button('Download raw data', utils.to_excel(df), file_name=f'{state}_data.xlsx')
+            utils.download_button('Download raw data', df, file_name=f'{state}_data.xlsx')
         if 'state_name' in df.columns:
             df = df.loc[:, ~df.columns.duplicated()]
             df['State'] = df['state_name']
@@ -115,7 +115,7 @@ def census_data_explorer():
         df.drop(['geom'], inplace=True, axis=1)
         visualization.make_census_chart(df, single_feature)
 
-        geo_df = geo_df[['geom', 'Census Tract']]
+        geo_df = queries.tract_geometry(geo_df, county_list if 'All' in counties else counties, state)
         show_transit=st.checkbox('Show transit lines and stops')
         visualization.make_map(geo_df, df, single_feature, show_transit=show_transit)
         if len(feature_labels) > 2:
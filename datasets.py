@@ -1,4 +1,8 @@
+import os
+import glob
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import api
 
 
@@ -12,15 +16,102 @@ class DataSet(object):
         self.path = self.directory + self.name + '.' + self.data_format
         self.sheet_name = sheet_name
 
-    def get_data(self):
+    @property
+    def cache_path(self) -> str:
+        # Parsed copies are keyed by the source's modification time, so editing the source invalidates them.
+        # Remote sources have no modification time and are not cached.
+        if api.is_url(self.path):
+            return None
+        mtime = os.stat(self.path).st_mtime_ns
+        sheet = '.' + self.sheet_name if self.data_format == 'xlsx' else ''
+        return os.path.join(self.directory, '.cache', f'{self.name}.{self.data_format}{sheet}.{mtime}.parquet')
+
+    def get_data(self, columns: list = None, filters: dict = None, chunksize: int = 100000,
+                 cache: bool = True) -> pd.DataFrame:
+        """Loads the source, keeping only the requested columns and the rows matching filters.
+        in:  columns to keep (all by default), dict of column -> value or list of values to keep,
+             rows per chunk for CSV sources, whether to read and write the Parquet cache
+        out: loaded data, also kept on self.data (integer columns with missing values read from the cache are float64)
+        """
+        needed = None
+        if columns:
+            needed = list(columns) + [c for c in (filters or {}) if c not in columns]
+        cache_path = self.cache_path if cache else None
+        if cache_path and os.path.exists(cache_path):
+            self.data = self._select(pd.read_parquet(cache_path, columns=needed), columns, filters)
+            return self.data
+
+        writer, schema = None, None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        frames = []
+        try:
+            for chunk in self._read_chunks(None if cache_path else needed, chunksize):
+                if cache_path:
+                    if writer is None:
+                        schema = self._cache_schema(chunk)
+                        writer = pq.ParquetWriter(cache_path + '.tmp', schema)
+                    writer.write_table(self._cache_table(chunk, schema))
+                frames.append(self._select(chunk, columns, filters))
+            if writer:
+                writer.close()
+                writer = None
+                for old in glob.glob(cache_path.rsplit('.', 2)[0] + '.*.parquet'):
+                    os.remove(old)
+                os.replace(cache_path + '.tmp', cache_path)
+        except Exception as e:
+            # Sources that can't be written as Parquet (e.g. mixed types in a column) are just not cached
+            if cache_path:
+                if writer:
+                    writer.close()
+                print(f'Could not cache {self.path}: {e}')
+                if os.path.exists(cache_path + '.tmp'):
+                    os.remove(cache_path + '.tmp')
+                return self.get_data(columns, filters, chunksize, cache=False)
+            raise
+
+        self.data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        return self.data
+
+    def _read_chunks(self, columns: list, chunksize: int):
+        if self.data_format == 'csv':
+            yield from pd.read_csv(api.open_source(self.path), usecols=columns, chunksize=chunksize)
+            return
         if self.data_format == 'xlsx':
-            self.data = api.get_from_excel(path=self.path, sheet_name=self.sheet_name)
+            df = api.get_from_excel(path=self.path, sheet_name=self.sheet_name)
         elif self.data_format == 'json':
-            self.data = api.get_from_json(path=self.path)
-        elif self.data_format == 'csv':
-            self.data = api.get_from_csv(path=self.path)
-
-        return self.data
+            df = api.get_from_json(path=self.path)
+        else:
+            return
+        yield df[columns] if columns else df
+
+    @staticmethod
+    def _cache_schema(df: pd.DataFrame) -> pa.Schema:
+        # Integers stay int64 (later chunks' missing values are stored as nulls), all-missing columns become strings
+        fields = []
+        for field in pa.Schema.from_pandas(df, preserve_index=False):
+            if pa.types.is_integer(field.type):
+                field = pa.field(field.name, pa.int64())
+            elif pa.types.is_null(field.type):
+                field = pa.field(field.name, pa.string())
+            fields.append(field)
+        return pa.schema(fields)
+
+    @staticmethod
+    def _cache_table(df: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+        df = df.copy()
+        for field in schema:
+            if pa.types.is_integer(field.type) and not pd.api.types.is_integer_dtype(df[field.name]):
+                # Whole numbers read as float64 because of missing values; fractions raise and skip the cache
+                df[field.name] = df[field.name].astype('Int64')
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    @staticmethod
+    def _select(df: pd.DataFrame, columns: list, filters: dict) -> pd.DataFrame:
+        for column, values in (filters or {}).items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            df = df[df[column].isin(set(values))]
+        return df[list(columns)] if columns else df
 
     @property
     def head(self):
@@ -49,8 +140,9 @@ class DataSet(object):
         return self.data
 
     def filter_counties(self, counties: list, column_to_filter) -> pd.DataFrame:
-        pattern = '|'.join(counties)
-        self.data = self.data[self.data[column_to_filter].str.contains(pattern)]
+        # Exact match on the trimmed, lowercased name via a set lookup
+        counties = set(c.strip().lower() for c in counties)
+        self.data = self.data[self.data[column_to_filter].astype(str).str.strip().str.lower().isin(counties)]
 
         return self.data
 
@@ -1,10 +1,11 @@
 import pandas as pd
 import streamlit as st
 
+import analysis
 import queries
 import utils
 import visualization
-from constants import STATES, EQUITY_DATA_TABLE, TRANSPORT_DATA_TABLE, LINKS
+from constants import STATES, EQUITY_DATA_TABLE, TRANSPORT_DATA_TABLE, LINKS, EQUITY_CONCENTRATIONS
 
 
 def census_equity_explorer():
@@ -39,7 +40,7 @@ def census_equity_explorer():
         if st.checkbox('Show raw data'):
             st.subheader('Raw Data')
             st.dataframe(df.iloc[:, 3:])
-            st.download_button('Download raw data', utils.to_excel(df), file_name=f'{state}_data.xlsx')
+            utils.download_button('Download raw data', df, file_name=f'{state}_data.xlsx')
         if 'state_name' in df.columns:
             df = df.loc[:, ~df.columns.duplicated()]
             df['State'] = df['state_name']
@@ -48,7 +49,9 @@ def census_equity_explorer():
             df['County Name'] = df['county_name']
         df.set_index(['State', 'County Name'], drop=True, inplace=True)
 
-        df = queries.clean_equity_data(df)
+        # The demographic indicators are evaluated once here and reused by the transportation analysis
+        shared = queries.shared_indicators(df)
+        df = queries.clean_equity_data(df, shared)
 
         st.write('''
                  
@@ -85,20 +88,20 @@ def census_equity_explorer():
 
         concentration = st.select_slider(
             'Limit the number of equity geographies by increasing the concentration requirements',
-            options=['Low', 'Medium', 'High'])
-        coeff = {'Low': 0.5, 'Medium': 1, 'High': 1.5}
+            options=list(EQUITY_CONCENTRATIONS))
 
         try:
             equity_df, total_census_tracts, concentration_thresholds, equity_averages, equity_epc_averages = queries.get_equity_geographies(
-                df, coeff[concentration])
+                df, EQUITY_CONCENTRATIONS[concentration])
 
             geo_df = equity_df.copy()
             geo_total = total_census_tracts.copy()
             df_copy = equity_df.copy()
             equity_df.drop(['geom'], inplace=True, axis=1)
             total_census_tracts.drop(['geom'], inplace=True, axis=1)
-            geo_df = geo_df[['geom', 'Census Tract']]
-            geo_total = geo_total[['geom', 'Census Tract']]
+            tract_counties = county_list if 'All' in counties else counties
+            geo_df = queries.tract_geometry(geo_df, tract_counties, state)
+            geo_total = queries.tract_geometry(geo_total, tract_counties, state)
 
             visualization.make_equity_census_map(geo_total, total_census_tracts, 'Criteria')
 
@@ -173,10 +176,10 @@ def census_equity_explorer():
             averages = {'Demographic Factors': equity_averages}
             epc_averages = {'Demographic Factors': equity_epc_averages}
             
-            epc['Transportation'], df['Transportation'], normalized_data['Transportation'], averages['Transportation'], epc_averages['Transportation'] = queries.clean_transport_data(transport_df, df_copy)
+            epc['Transportation'], df['Transportation'], normalized_data['Transportation'], averages['Transportation'], epc_averages['Transportation'] = queries.clean_transport_data(transport_df, df_copy, shared)
 
-            geo_df = df['Transportation'].copy()[['geom', 'Census Tract']]
-            geo_epc = epc['Transportation'].copy()[['geom', 'Census Tract']]
+            geo_df = queries.tract_geometry(df['Transportation'], tract_counties, state)
+            geo_epc = queries.tract_geometry(epc['Transportation'], tract_counties, state)
             
             tables = queries.CLIMATE_CENSUS_TABLES
             tables = [_.strip().lower() for _ in tables]
@@ -299,16 +302,11 @@ def census_equity_explorer():
             st.write('''##### Equity Vulnerability Index''')
             st.caption('Equity geographies are sorted based on each of the equity vulnerability index values')
 
-            combined_normalized_data = normalized_data['Transportation'].merge(normalized_data['Climate'],how='outer', on='Census Tract', suffixes=('', '_DROP')).filter(
-                regex='^(?!.*_DROP)')
-            combined_normalized_data = combined_normalized_data.melt('Census Tract', selected_indicators, 'Indicators')
-            combined_normalized_data.rename({'value': 'Index Value'}, axis=1, inplace=True)
-            combined_normalized_data['Index Value'] = combined_normalized_data['Indicators'].apply(lambda x: index_value[x]) * \
-                                            combined_normalized_data['Index Value']
-            transport_index = combined_normalized_data.groupby(['Census Tract'])['Index Value'].sum()
-            visualization.make_stacked(combined_normalized_data)
-
-            transport_index.sort_values(ascending=False, inplace=True)
+            tracts, matrix = analysis.index_matrix([normalized_data['Transportation'], normalized_data['Climate']],
+                                                   selected_indicators)
+            weights = analysis.index_weights(index_value, selected_indicators)
+            transport_index = analysis.vulnerability_index(tracts, matrix, weights)
+            visualization.make_stacked(analysis.index_contributions(tracts, matrix, weights, selected_indicators))
 
             st.write('##### Locate the census tracts with the highest index values')
             num_tracts = st.slider('Select number of census tracts to view',
@@ -316,24 +314,45 @@ def census_equity_explorer():
                                 value=[5 if 5 < len(transport_index) else len(transport_index)]
                                 )[0]
 
-            selected = transport_index.head(num_tracts).reset_index()
+            selected = analysis.top_values(transport_index, num_tracts)
             combined_epc = epc['Transportation'].merge(epc['Climate'],how='outer', on='Census Tract', suffixes=('', '_DROP')).filter(
                 regex='^(?!.*_DROP)')
-            selected_tracts = combined_epc.copy().loc[combined_epc['Census Tract'].isin(selected['Census Tract'])]
-            selected_tracts['value'] = selected_tracts['Census Tract'].apply(lambda x: transport_index.loc[x])
-            selected_geo = geo_epc.copy().loc[geo_epc['Census Tract'].isin(selected['Census Tract'])]
-            selected_geo['Index Value'] = selected_geo['Census Tract'].apply(lambda x: round(transport_index.loc[x]))
+            selected_tracts = combined_epc.loc[combined_epc['Census Tract'].isin(selected.index)].copy()
+            selected_tracts['value'] = selected_tracts['Census Tract'].map(selected)
+            selected_geo = geo_epc.loc[geo_epc['Census Tract'].isin(selected.index)].copy()
+            selected_geo['Index Value'] = selected_geo['Census Tract'].map(selected).round().astype(int)
             selected_geo_copy = selected_geo.copy()
             selected_tracts_copy = selected_tracts.copy()
             visualization.make_transport_census_map(selected_geo, selected_tracts, 'Index Value', False, selected_tracts)
             
             with st.expander('Download data at the census tract level'):
                 st.caption('Values for selected indicators are shown for the census tracts with the highest index values')
-                selected_tracts_df = df.loc[(df.index).isin(selected['Census Tract'])][
+                selected_tracts_df = df.loc[(df.index).isin(selected.index)][
                     queries.TRANSPORT_CENSUS_HEADERS + queries.POSITIVE_TRANSPORT_CENSUS_HEADERS]
                 st.dataframe(selected_tracts_df)
-                st.download_button('Download', utils.to_excel(selected_tracts_df),
+                utils.download_button('Download', selected_tracts_df,
                                 file_name=f'{state}_selected_transport_data.xlsx')
+
+            with st.expander('Test how sensitive the index is to the weights'):
+                st.caption('Ranks every census tract under many alternative weightings of the selected indicators. '
+                           'Tracts with a low mean rank and a small spread rank highly regardless of the exact weights.')
+                method = st.radio('Weightings to test', ['Random', 'Grid'], key='sensitivity_method')
+                samples = None
+                if len(selected_indicators) == 0:
+                    st.error('Select at least one indicator to test how sensitive the index is to its weights')
+                elif method == 'Random':
+                    samples = analysis.weight_samples(len(selected_indicators), 'random',
+                                                      samples=st.number_input('Number of weightings', min_value=100,
+                                                                              max_value=50000, value=2000, step=100))
+                else:
+                    step = st.select_slider('Weight step (%)', options=[5, 10, 20, 25, 50], value=10)
+                    try:
+                        samples = analysis.weight_samples(len(selected_indicators), 'grid', step=step)
+                    except ValueError as e:
+                        st.error(str(e))
+                if samples is not None:
+                    sensitivity = analysis.weight_sensitivity(tracts, matrix, samples, top_n=num_tracts)
+                    st.dataframe(sensitivity.head(max(25, num_tracts)))
    
         except:
             st.error('Equity Vulnerability Index cannot be shown for this geography at this time. Please select a different region.')
@@ -51,7 +51,7 @@ def eviction_UI():
                     if st.checkbox('Show raw data'):
                         st.subheader('Raw Data')
                         st.dataframe(df)
-                        st.download_button('Download raw data', utils.to_excel(df), file_name=f'{county}_data.xlsx')
+                        utils.download_button('Download raw data', df, file_name=f'{county}_data.xlsx')
 
                     with st.expander('Cost to avoid evictions'):
                         st.write("""
@@ -71,7 +71,7 @@ def eviction_UI():
 
                     if st.checkbox('Do cost to avoid eviction analysis?'):
                         evictions_cost_df = cost_of_evictions(df, metro_areas, locations)
-                        st.download_button('Download cost data', utils.to_excel(evictions_cost_df),
+                        utils.download_button('Download cost data', evictions_cost_df,
                                         file_name=f'{county}_cost_data.xlsx')
 
                 else:
@@ -90,7 +90,7 @@ def eviction_UI():
                 if st.checkbox('Show raw data'):
                     st.subheader('Raw Data')
                     st.dataframe(df)
-                    st.download_button('Download raw data', utils.to_excel(df), file_name=f'{state}_data.xlsx')
+                    utils.download_button('Download raw data', df, file_name=f'{state}_data.xlsx')
 
                 with st.expander('Cost to avoid evictions'):
                     st.write("""
@@ -110,7 +110,7 @@ def eviction_UI():
 
                 if st.checkbox('Do cost to avoid eviction analysis?'):
                     evictions_cost_df = cost_of_evictions(df, metro_areas, locations)
-                    st.download_button('Download cost data', utils.to_excel(evictions_cost_df),
+                    utils.download_button('Download cost data', evictions_cost_df,
                                     file_name=f'{state}_cost_data.xlsx')
 
                 ranks = relative_risk_ranking(df, state)
@@ -125,7 +125,7 @@ def eviction_UI():
             if st.checkbox('Show raw data'):
                 st.subheader('Raw Data')
                 st.dataframe(df)
-                st.download_button('Download raw data', utils.to_excel(df), file_name=f'{state}_data.xlsx')
+                utils.download_button('Download raw data', df, file_name=f'{state}_data.xlsx')
 
             with st.expander('Cost to avoid evictions'):
                 st.write("""
@@ -145,7 +145,7 @@ def eviction_UI():
 
             if st.checkbox('Do cost to avoid eviction analysis?'):
                 evictions_cost_df = cost_of_evictions(df, metro_areas, locations)
-                st.download_button('Download raw data', utils.to_excel(evictions_cost_df),
+                utils.download_button('Download raw data', evictions_cost_df,
                                 file_name=f'{state}_cost_data.xlsx')
 
             ranks = relative_risk_ranking(df, state)
@@ -157,15 +157,11 @@ def eviction_UI():
                 st.write(
                     "There are some counties that don't show up in this analysis because of how they are named or because data is missing. We are aware of this issue.")
 
-            frames = []
-            for state in STATES:
-                df = queries.get_county_data(state)
-                frames.append(df)
-            natl_df = pd.concat(frames)
+            natl_df, natl_features = analysis.national_features()
             if st.checkbox('Show raw data'):
                 st.subheader('Raw Data')
                 st.dataframe(natl_df)
-                st.download_button('Download raw data', utils.to_excel(natl_df), file_name=f'national_data.xlsx')
+                utils.download_button('Download raw data', natl_df, file_name=f'national_data.xlsx')
             with st.expander('Cost to avoid evictions'):
                 st.write("""
                         The cost to avoid evictions is defined as the cost to a municipality or other entity if it was to pay 
@@ -184,10 +180,10 @@ def eviction_UI():
 
             if st.checkbox('Do cost to avoid eviction analysis?'):
                 evictions_cost_df = cost_of_evictions(natl_df, metro_areas, locations)
-                st.download_button('Download cost data', utils.to_excel(evictions_cost_df),
+                utils.download_button('Download cost data', evictions_cost_df,
                                 file_name=f'national_cost_data.xlsx')
 
-            ranks = relative_risk_ranking(natl_df, 'National')
+            ranks = relative_risk_ranking(natl_df, 'National', natl_features)
             eviction_visualizations(ranks, 'National')
     except:
         st.error('Data cannot be shown for this geography at this time. Please select a different region.')
@@ -203,21 +199,19 @@ def eviction_visualizations(df: pd.DataFrame, state: str = None):
             geo_df = queries.get_county_geoms(counties, state)
             visualization.make_map(geo_df, temp, 'Relative Risk')
         else:
-            frames = []
-            for s in STATES:
-                frames.append(queries.get_county_geoms(counties, s))
-            geo_df = pd.concat(frames)
+            geo_df = queries.get_national_county_geom_data(counties)
             visualization.make_map(geo_df, temp, 'Relative Risk')
 
 
-def relative_risk_ranking(df: pd.DataFrame, label: str) -> pd.DataFrame:
+def relative_risk_ranking(df: pd.DataFrame, label: str, precomputed: tuple = None) -> pd.DataFrame:
     st.subheader('Relative Risk')
     st.write('Relative Risk is a metric to compare the potential risk of eviction between multiple counties. '
              'Values are normalized and combined to create the Relative Risk index. '
              'You can add or remove features, or just use our defaults which we developed working with our partners.')
+    features = sorted(set(df.columns) - {'county_id', 'state_id', 'cnty_fips', 'fips',
+                                         'pop_sqmi', 'pop2010', 'pop2010_sqmi'})
     columns_to_consider = st.multiselect('Features to consider in Relative Risk',
-                                         list(set(df.columns) - {'county_id', 'state_id', 'cnty_fips', 'fips',
-                                                                 'pop_sqmi', 'pop2010', 'pop2010_sqmi'}),
+                                         features,
                                          ["burdened_households",
                                           "income_inequality",
                                           "population_below_poverty",
@@ -228,41 +222,49 @@ def relative_risk_ranking(df: pd.DataFrame, label: str) -> pd.DataFrame:
                                           "Vacant Units",
                                           "Renter Occupied Units",
                                           "Non-White Population (%)"]) + ['Total Population']
-    ranks = analysis.rank_counties(df[columns_to_consider], label + '_selected_counties').sort_values(
+    crossed = st.checkbox('Include pairwise interactions between features', False,
+                          help='Adds the mean of the products of every pair of selected features to Relative Risk')
+    ranks = analysis.rank_counties(df[features], columns_to_consider, crossed=crossed,
+                                   precomputed=precomputed).sort_values(
         by='Relative Risk',
         ascending=False)
     ranks['county_id'] = df['county_id']
     ranks['state_id'] = df['state_id']
     st.write('Higher values correspond to more relative risk. Values can be between 0 and 1.')
     st.dataframe(ranks['Relative Risk'])
-    st.download_button('Download Relative Risk ranking', utils.to_excel(ranks), file_name=f'{label}_data.xlsx')
+    utils.download_button('Download Relative Risk ranking', ranks, file_name=f'{label}_data.xlsx')
+
+    if st.checkbox('Show how Relative Risk has changed over time'):
+        period = st.selectbox('Period', queries.FRED_PERIODS, len(queries.FRED_PERIODS) - 1)
+        counties_str = "(" + ",".join(["'" + str(_) + "'" for _ in ranks['county_id']]) + ")"
+        trend = analysis.risk_trend(queries.fred_time_series(counties_str, period))
+        names = pd.Series(ranks.index.get_level_values(-1), index=ranks['county_id'].astype(str))
+        trend['County Name'] = trend['county_id'].astype(str).map(names)
+        top_counties = ranks['county_id'].astype(str).head(10)
+        st.caption('Relative Risk from the FRED indicators alone, shown for the 10 counties with the highest current '
+                   'Relative Risk')
+        visualization.make_trend_chart(trend.loc[trend['county_id'].astype(str).isin(top_counties)], 'Relative Risk',
+                                       'County Name')
 
     return ranks
 
 
 def cost_of_evictions(df: pd.DataFrame, metro_areas, locations):
     st.write('You can use either the Fair Market or Median rents in a county for this analysis.')
-    rent_type = st.selectbox('Rent Type', ['Fair Market', 'Median'], 0)
+    rent_type = st.selectbox('Rent Type', list(analysis.RENT_TYPES), 0)
     st.write('This calculation is based on the combined rent for 0 bedroom to 4+ bedroom units. The distribution of '
              'housing stock changes around the US, so you can pick a distribution similar to your location or just use '
              'the national average. You can then select a proportion of the rent-burdened population to support.')
     location = st.selectbox('Select a location to assume a housing distribution:', locations)
-    distribution = {
-        0: float(metro_areas.loc[location, '0_br_pct']),
-        1: float(metro_areas.loc[location, '1_br_pct']),
-        2: float(metro_areas.loc[location, '2_br_pct']),
-        3: float(metro_areas.loc[location, '3_br_pct']),
-        4: float(metro_areas.loc[location, '4_br_pct']),
-    }
+    distribution = analysis.location_distribution(metro_areas, location)
     if st.checkbox('Show distribution (decimal values)'):
         st.write(distribution)
 
     pct_burdened = st.slider('Percent of Burdened Population to Support', 0, 100, value=50, step=1)
 
-    if rent_type == '' or rent_type == 'Fair Market':
-        df = analysis.calculate_cost_estimate(df, pct_burdened, rent_type='fmr', distribution=distribution)
-    elif rent_type == 'Median':
-        df = analysis.calculate_cost_estimate(df, pct_burdened, rent_type='rent50', distribution=distribution)
+    county_df = df
+    df = analysis.calculate_cost_estimate(df, pct_burdened, rent_type=analysis.RENT_TYPES.get(rent_type, 'fmr'),
+                                          distribution=distribution)
 
     cost_df = df.reset_index()
     cost_df.drop(columns=['State'], inplace=True)
@@ -279,4 +281,8 @@ def cost_of_evictions(df: pd.DataFrame, metro_areas, locations):
                  ' burdened population for each type of unit. `total_cost` is sum of the `br_cost_` for each type of'
                  ' housing unit.')
         st.dataframe(cost_df)
+    if st.checkbox('Compare housing distributions and rent types'):
+        compared = st.multiselect('Housing distributions to compare', locations, [location])
+        scenarios = analysis.cost_scenarios(county_df, metro_areas)
+        visualization.make_cost_scenarios_chart(scenarios.loc[scenarios['Location'].isin(compared)])
     return cost_df
@@ -1,6 +1,7 @@
 import os
 import sys
 import psycopg2
+import numpy as np
 import pandas as pd
 import fiona
 import geopandas as gpd
@@ -10,7 +11,8 @@ import streamlit as st
 from sklearn import preprocessing
 
 import credentials
-from constants import STATES
+import utils
+from constants import STATES, EXTENT_COLUMNS, EQUITY_CONCENTRATIONS
 
 FRED_TABLES = [
     'burdened_households',
@@ -23,6 +25,11 @@ FRED_TABLES = [
     'unemployment_rate',
 ]
 
+FRED_PERIODS = ['month', 'quarter', 'year']
+
+# Written by scripts.refresh_FRED each time it loads new observations
+FRED_WATERMARK_TABLE = 'fred_refresh_watermarks'
+
 STATIC_TABLES = [
     'chmura_economic_vulnerability_index',
     'fair_market_rents'
@@ -35,6 +42,11 @@ STATIC_COLUMNS = {
     'median_rents': ['rent50_0', 'rent50_1', 'rent50_2', 'rent50_3', 'rent50_4']
 }
 
+RENT_TABLES = {
+    'fmr': ('fair_market_rents_new', 'fair_market_rents'),
+    'rent50': ('median_rents_new', 'median_rents')
+}
+
 TABLE_HEADERS = {
     'burdened_households': 'Burdened Households',
     'homeownership_rate': 'Home Ownership',
@@ -187,6 +199,61 @@ CLIMATE_CENSUS_TABLES = [
     'national_risk_index'
 ]
 
+# Indicators derived from census tract columns: the sum of the numerator columns (less any subtracted columns),
+# divided by the sum of the denominator columns when given, times the scale. Columns may name other indicators.
+DERIVED_INDICATORS = {
+    'Age 19 or Under': {'numerator': [
+        'female_under_5', 'female_5_to_9', 'female_10_to_14', 'female_15_to_17', 'female_18_and_19',
+        'male_under_5', 'male_5_to_9', 'male_10_to_14', 'male_15_to_17', 'male_18_and_19'
+    ]},
+    'Age 65 or Over': {'numerator': [
+        'female_65_and_66', 'female_67_to_69', 'female_70_to_74', 'female_75_to_79', 'female_80_to_84',
+        'female_85_and_over',
+        'male_65_and_66', 'male_67_to_69', 'male_70_to_74', 'male_75_to_79', 'male_80_to_84', 'male_85_and_over'
+    ]},
+    'total_w_a_disability': {'numerator': [
+        'male_under_5_w_a_disability', 'male_5_to_17_w_a_disability', 'male_18_to_34_w_a_disability',
+        'male_35_to_64_w_a_disability', 'male_65_to_74_w_a_disability', 'male_75_and_over_w_a_disability',
+        'female_under_5_w_a_disability', 'female_5_to_17_w_a_disability', 'female_18_to_34_w_a_disability',
+        'female_35_to_64_w_a_disability', 'female_65_to_74_w_a_disability', 'female_75_and_over_w_a_disability'
+    ]},
+    'speak_eng_not_well': {'numerator': [
+        'foreign_speak_spanish_speak_eng_not_well', 'foreign_speak_spanish_speak_eng_not_at_all',
+        'foreign_speak_other_indo-euro_speak_eng_not_well', 'foreign_speak_other_indo-euro_speak_eng_not_at_all',
+        'foreign_speak_asian_or_pac_isl_lang_speak_eng_not_well',
+        'foreign_speak_asian_or_pac_isl_lang_speak_eng_not_at_all',
+        'foreign_speak_other_speak_eng_not_well', 'foreign_speak_other_speak_eng_not_at_all'
+    ]},
+    'single_parent': {'numerator': [
+        'other_male_householder_no_spouse_w_kids', 'other_female_householder_no_spouse_w_kids'
+    ]},
+    'non-white': {'numerator': ['total_population'], 'subtract': ['not_hisp_or_latino_white']},
+    'People of Color (%)': {'numerator': ['non-white'], 'denominator': ['total_population'], 'scale': 100},
+    '200% Below Poverty Level (%)': {'numerator': ['200_below_pov_level'],
+                                     'denominator': ['population_for_whom_poverty_status_is_determined'],
+                                     'scale': 100},
+    'Age 19 or Under (%)': {'numerator': ['Age 19 or Under'], 'denominator': ['total_population'], 'scale': 100},
+    'Age 65 or Over (%)': {'numerator': ['Age 65 or Over'], 'denominator': ['total_population'], 'scale': 100},
+    'Limited English Proficiency (%)': {'numerator': ['speak_eng_not_well'],
+                                        'denominator': ['native', 'foreign_born'], 'scale': 100},
+    'Single Parent Family (%)': {'numerator': ['single_parent'], 'denominator': ['total_families'], 'scale': 100},
+    'People with Disability (%)': {'numerator': ['total_w_a_disability'], 'denominator': ['male', 'female'],
+                                   'scale': 100},
+    'No Computer Households (%)': {'numerator': ['household_no_computing_device'], 'denominator': [
+        'household_no_computing_device', 'household_computer', 'household_smartphone_no_computer',
+        'household_no_internet', 'household_broadband'
+    ], 'scale': 100},
+    'Renter Occupied Units (%)': {'numerator': ['renter-occ_units'], 'denominator': ['occupied_housing_units'],
+                                  'scale': 100},
+}
+
+# Indicators used by both the equity and transportation analyses, evaluated once by shared_indicators
+SHARED_INDICATORS = [
+    'Age 19 or Under', 'Age 65 or Over', 'speak_eng_not_well', 'single_parent', 'non-white',
+    'People of Color (%)', '200% Below Poverty Level (%)', 'Age 19 or Under (%)', 'Age 65 or Over (%)',
+    'Limited English Proficiency (%)', 'Single Parent Family (%)'
+]
+
 
 def init_engine():
     engine = create_engine(
@@ -273,7 +340,8 @@ def read_table(table: str, columns: list = None, where: str = None, order_by: st
 def latest_data_census_tracts(state: str, counties: list, tables: list) -> pd.DataFrame:
     conn = init_connection()
     cur = conn.cursor()
-    tracts_df = census_tracts_geom_query(counties, state)
+    # Extents stay with the geometry loader's frame; tract_geometry attaches them to the slice the maps read
+    tracts_df = census_tracts_geom_query(counties, state).drop(EXTENT_COLUMNS, axis=1)
     counties_str = str(tuple(counties)).replace(',)', ')')
     where_clause = f"WHERE id_index.state_name ='{state}' AND id_index.county_name IN {counties_str}"
 
@@ -300,6 +368,20 @@ def latest_data_census_tracts(state: str, counties: list, tables: list) -> pd.Da
     return tracts_df
 
 
+def tract_geometry(df: pd.DataFrame, counties: list, state: str) -> pd.DataFrame:
+    """Geometry slice of a census tract frame for the maps, with the extents stored by census_tracts_geom_query.
+    in:  census tract frame from latest_data_census_tracts, the counties and state it was queried for
+    out: the frame's geom and Census Tract columns, indexed like the frame, with EXTENT_COLUMNS
+    """
+    extents = census_tracts_geom_query(counties, state).drop_duplicates('Census Tract')
+    extents = extents.set_index('Census Tract')[EXTENT_COLUMNS].reindex(df['Census Tract'])
+    geo_df = df[['geom', 'Census Tract']].copy()
+    for column in EXTENT_COLUMNS:
+        geo_df[column] = extents[column].to_numpy()
+    return geo_df
+
+
+@st.experimental_memo(ttl=3600)
 def load_distributions() -> tuple:
     metro_areas = generic_select_query('housing_stock_distribution', [
         'location',
@@ -368,6 +450,59 @@ def fred_query(counties_str: str) -> pd.DataFrame:
     return fred_df
 
 
+@st.experimental_memo(ttl=1200)
+def fred_time_series(counties_str: str, period: str = 'year', start: str = None, end: str = None,
+                     tables: tuple = tuple(FRED_TABLES)) -> dict:
+    # Averages each FRED indicator per county and period in SQL and returns a county x period x indicator cube
+    if period not in FRED_PERIODS:
+        raise ValueError(f'Period must be one of {FRED_PERIODS}')
+    where = f"county_id IN {counties_str}"
+    if start is not None:
+        where += f" AND date >= '{start}'"
+    if end is not None:
+        where += f" AND date <= '{end}'"
+    query = ' UNION ALL '.join(
+        f"""SELECT county_id, '{table}' AS indicator, CAST(date_trunc('{period}', date) AS DATE) AS period,
+                  AVG(CAST({table} AS FLOAT)) AS value
+             FROM {table}_new WHERE {where}
+             GROUP BY county_id, period""" for table in tables) + ';'
+    conn = init_connection()
+    df = pd.read_sql(query, con=conn)
+
+    county_codes, county_ids = pd.factorize(df['county_id'], sort=True)
+    period_codes, periods = pd.factorize(pd.to_datetime(df['period']), sort=True)
+    indicator_codes = pd.Index(tables).get_indexer(df['indicator'])
+    values = np.full((len(county_ids), len(periods), len(tables)), np.nan)
+    values[county_codes, period_codes, indicator_codes] = df['value'].to_numpy(dtype='float64')
+    return {'county_id': np.asarray(county_ids), 'date': np.asarray(periods), 'indicators': list(tables),
+            'values': values}
+
+
+@st.experimental_memo(ttl=300)
+def fred_refreshed_at() -> str:
+    conn = init_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (FRED_WATERMARK_TABLE,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(f"SELECT max(refreshed_at)::text FROM {FRED_WATERMARK_TABLE};")
+    return cur.fetchone()[0]
+
+
+@st.experimental_singleton
+def _fred_refresh_state() -> dict:
+    return {'refreshed_at': None}
+
+
+def clear_stale_caches():
+    # scripts.refresh_FRED runs in its own process, so the app clears its memoized queries when it sees a newer load
+    refreshed_at = fred_refreshed_at()
+    state = _fred_refresh_state()
+    if state['refreshed_at'] is not None and refreshed_at != state['refreshed_at']:
+        st.experimental_memo.clear()
+    state['refreshed_at'] = refreshed_at
+
+
 @st.experimental_memo(ttl=1200)
 def get_all_county_data(state: str, counties: list) -> pd.DataFrame:
     if counties:
@@ -434,6 +569,13 @@ def static_data_single_table(table_name: str, columns: list) -> pd.DataFrame:
     return df
 
 
+@st.experimental_memo(ttl=3600)
+def rent_table(rent_type: str) -> pd.DataFrame:
+    # rent_type is 'fmr' (fair market) or 'rent50' (median); columns are county_id and {rent_type}_0 to _4
+    table_name, columns = RENT_TABLES[rent_type]
+    return static_data_single_table(table_name, STATIC_COLUMNS[columns])
+
+
 def generic_select_query(table_name: str, columns: list, where: str = None) -> pd.DataFrame:
     conn = init_connection()
     cur = conn.cursor()
@@ -473,6 +615,7 @@ def get_county_geoms(counties_list: list, state: str) -> pd.DataFrame:
     geom_df['State'] = df['state_name']
     geom_df['Area sqmi'] = df['sqmi']
     geom_df['geom'] = pd.Series(parcels)
+    geom_df = geom_df.join(utils.geom_extents(geom_df['geom']))
     return geom_df
 
 
@@ -498,6 +641,7 @@ def get_county_geoms_by_id(counties_list: list) -> pd.DataFrame:
     geom_df['State'] = df['state_name']
     geom_df['Area sqmi'] = df['sqmi']
     geom_df['geom'] = pd.Series(parcels)
+    geom_df = geom_df.join(utils.geom_extents(geom_df['geom']))
     return geom_df
 
 
@@ -530,6 +674,7 @@ def census_tracts_geom_query(counties, state) -> pd.DataFrame:
     geom_df = pd.DataFrame()
     geom_df['Census Tract'] = df['tract_id']
     geom_df['geom'] = pd.Series(parcels)
+    geom_df = geom_df.join(utils.geom_extents(geom_df['geom']))
     return geom_df
 
 
@@ -564,6 +709,53 @@ def get_transit_shapes_geoms(columns: list = [], where: str = None) -> pd.DataFr
     return df
 
 
+def _tract_index(tract_ids: pd.Series, rows: np.ndarray) -> dict:
+    index = pd.Series(rows).groupby(tract_ids.astype(str).to_numpy()).unique()
+    return {tract: np.sort(r) for tract, r in index.items()}
+
+
+@st.experimental_memo(ttl=3600)
+def get_transit_package(state: str) -> dict:
+    conn = init_connection()
+    shapes = gpd.read_postgis(f"""
+        SELECT ntm_shapes.route_desc, ntm_shapes.route_type_text, ntm_shapes.route_long_name, ntm_shapes.length,
+            ntm_shapes.tract_id, ntm_shapes.geom
+        FROM ntm_shapes
+        INNER JOIN id_index ON ntm_shapes.tract_id = id_index.tract_id
+        WHERE id_index.state_name = '{state}';""", conn)
+    stops = gpd.read_postgis(f"""
+        SELECT ntm_stops.stop_name, ntm_stops.stop_lat, ntm_stops.stop_lon, ntm_stops.tract_id, ntm_stops.geom
+        FROM ntm_stops
+        INNER JOIN id_index ON ntm_stops.tract_id = id_index.tract_id
+        WHERE id_index.state_name = '{state}';""", conn)
+
+    # Shapes are stored once per intersected tract, so each route is kept once and referenced from the index
+    route_ids, _ = pd.factorize(shapes['geom'].apply(lambda g: g.wkb))
+    routes = shapes.loc[~pd.Series(route_ids).duplicated().to_numpy()].reset_index(drop=True)
+    routes['path'] = routes['geom'].apply(lambda g: utils.coord_extractor(g.simplify(0.0000750, preserve_topology=False)))
+    routes = routes.drop(['geom', 'tract_id'], axis=1).fillna('N/A')
+
+    stop_ids, _ = pd.factorize(stops['geom'].apply(lambda g: g.wkb))
+    unique_stops = stops.loc[~pd.Series(stop_ids).duplicated().to_numpy()].reset_index(drop=True)
+
+    return {
+        'routes': routes,
+        'stops': unique_stops[['stop_name', 'stop_lon', 'stop_lat']],
+        'route_index': _tract_index(shapes['tract_id'], route_ids),
+        'stop_index': _tract_index(stops['tract_id'], stop_ids),
+    }
+
+
+def transit_for_tracts(state: str, tracts: list) -> tuple:
+    package = get_transit_package(state)
+    tracts = [str(t) for t in tracts]
+    route_rows = [package['route_index'][t] for t in tracts if t in package['route_index']]
+    stop_rows = [package['stop_index'][t] for t in tracts if t in package['stop_index']]
+    route_rows = np.unique(np.concatenate(route_rows)) if route_rows else np.array([], dtype=int)
+    stop_rows = np.unique(np.concatenate(stop_rows)) if stop_rows else np.array([], dtype=int)
+    return package['routes'].iloc[route_rows], package['stops'].iloc[stop_rows]
+
+
 @st.experimental_memo(ttl=1200)
 def static_data_all_table() -> pd.DataFrame:
     counties_df = all_counties_query()
@@ -574,15 +766,15 @@ def static_data_all_table() -> pd.DataFrame:
 
 
 def output_data(df: pd.DataFrame, table_name: str = 'fred_tables', ext: str = 'xlsx') -> str:
-    path = f'Output/{table_name}.{ext}'
     if ext == 'pk':
+        path = f'Output/{table_name}.{ext}'
         df.to_pickle(path)
-    elif ext == 'xlsx':
-        df.to_excel(path)
-    elif ext == 'csv':
-        df.to_csv(path)
+    elif ext in utils.EXPORT_FORMATS:
+        ext = utils.export_format(df, ext)
+        path = utils.export_file_name(f'Output/{table_name}', ext)
+        utils.write_export(df, path, ext)
     else:
-        print('Only .pk, .csv, and .xlsx outputs are currently supported.')
+        print(f"Only {', '.join(['pk'] + list(utils.EXPORT_FORMATS))} outputs are currently supported.")
         sys.exit()
     return path
 
@@ -770,95 +962,134 @@ def clean_climate_data(data: pd.DataFrame, epc: pd.DataFrame) -> pd.DataFrame:
 #     return transport_epc, data, normalized_data, averages, epc_averages
 
 
-def get_equity_geographies(epc: pd.DataFrame, coeff: float) -> pd.DataFrame:
-    concentration_thresholds = dict()
-    averages = dict()
-
-    for header in (EQUITY_CENSUS_POC_LOW_INCOME + EQUITY_CENSUS_REMAINING_HEADERS):
-        averages[header+ ' (%)'] = epc[header + ' (%)'].mean()
-        concentration_thresholds[header+ ' (%)'] = averages[header+ ' (%)'] + coeff * epc[header + ' (%)'].std()
-        epc[header + '_check'] = epc[header + ' (%)'].apply(lambda x: x > concentration_thresholds[header+ ' (%)'])
-        epc[header + '_check'] = epc[header + '_check'].astype(int)
+@st.experimental_memo(ttl=1200)
+def equity_geography_scenarios(values: np.ndarray, coeffs: tuple = tuple(EQUITY_CONCENTRATIONS.values())) -> dict:
+    # values: tracts x (EQUITY_CENSUS_POC_LOW_INCOME + EQUITY_CENSUS_REMAINING_HEADERS) percentages
+    averages = np.nanmean(values, axis=0)
+    thresholds = averages + np.array(coeffs)[:, None] * np.nanstd(values, axis=0, ddof=1)
+    checks = values[None, :, :] > thresholds[:, None, :]
+
+    n_poc_low_income = len(EQUITY_CENSUS_POC_LOW_INCOME)
+    low_income = checks[:, :, EQUITY_CENSUS_POC_LOW_INCOME.index('200% Below Poverty Level')]
+    criteria_a_count = checks[:, :, :n_poc_low_income].sum(axis=2)
+    criteria_b_count = checks[:, :, n_poc_low_income:].sum(axis=2)
+    criteria_a = criteria_a_count == n_poc_low_income
+    criteria_b = (criteria_b_count >= 3) & low_income
+    labels = np.select([criteria_a & criteria_b, criteria_a, criteria_b],
+                       ['Equity Geography (Meets Both Criteria)', 'Equity Geography (Meets Criteria A)',
+                        'Equity Geography (Meets Criteria B)'],
+                       'Not selected as an Equity Geography')
+
+    return {coeff: {'averages': averages, 'thresholds': thresholds[i], 'checks': checks[i],
+                    'criteria_A': criteria_a_count[i], 'criteria_B': criteria_b_count[i],
+                    'Criteria A': criteria_a[i], 'Criteria B': criteria_b[i], 'Criteria': labels[i]}
+            for i, coeff in enumerate(coeffs)}
 
-    epc['criteria_A'] = epc[[x + '_check' for x in EQUITY_CENSUS_POC_LOW_INCOME]].sum(axis=1, numeric_only=True)
-    epc['Criteria A'] = epc['criteria_A'].apply(lambda x: bool(x == 2))
 
-    epc['criteria_B'] = epc[[x + '_check' for x in EQUITY_CENSUS_REMAINING_HEADERS]].sum(axis=1, numeric_only=True)
-    temp = epc['200% Below Poverty Level (%)'].apply(lambda x: x > concentration_thresholds['200% Below Poverty Level (%)'])
-    epc['Criteria B'] = (epc['criteria_B'].apply(lambda x: bool(x >= 3)) + temp.astype(int)) == 2
+def get_equity_geographies(epc: pd.DataFrame, coeff: float) -> pd.DataFrame:
+    headers = EQUITY_CENSUS_POC_LOW_INCOME + EQUITY_CENSUS_REMAINING_HEADERS
+    percent_headers = [header + ' (%)' for header in headers]
+    values = epc[percent_headers].to_numpy(dtype='float64')
+    scenarios = equity_geography_scenarios(values)
+    scenario = scenarios[coeff] if coeff in scenarios else equity_geography_scenarios(values, (coeff,))[coeff]
+
+    averages = dict(zip(percent_headers, scenario['averages']))
+    concentration_thresholds = dict(zip(percent_headers, scenario['thresholds']))
+    for i, header in enumerate(headers):
+        epc[header + '_check'] = scenario['checks'][:, i].astype(int)
+    for column in ['criteria_A', 'Criteria A', 'criteria_B', 'Criteria B', 'Criteria']:
+        epc[column] = scenario[column]
+    selected = scenario['Criteria A'] | scenario['Criteria B']
 
     df = epc
+    epc = epc.loc[selected]
+    df['Category'] = np.where(selected, 'Equity Geography', 'Other')
 
-    epc['Criteria'] = epc[['Criteria A', 'Criteria B']].apply(
-        lambda x: 'Equity Geography (Meets Both Criteria)' if (x['Criteria A'] & x['Criteria B']) else
-        ('Equity Geography (Meets Criteria A)' if x['Criteria A'] else
-         ('Equity Geography (Meets Criteria B)' if x['Criteria B'] else 'Not selected as an Equity Geography')),
-        axis=1)
-    # epc['Criteria'] = epc.apply(lambda x: 'Both' if (x['Criteria A'] | x['Criteria B']) else 'Other')
-    epc = epc.loc[(epc['Criteria A'] | epc['Criteria B'])]
-    df['Category'] = (df['Criteria A'].apply(lambda x: bool(x)) | df['Criteria B'].apply(lambda x: bool(x)))
-    df['Category'] = df['Category'].apply(lambda x: 'Equity Geography' if x is True else 'Other')
-
-    epc_averages = {}
-    for header in (EQUITY_CENSUS_POC_LOW_INCOME + EQUITY_CENSUS_REMAINING_HEADERS):
-        epc_averages[header+ ' (%)'] = epc[header + ' (%)'].mean()
+    epc_averages = epc[percent_headers].mean().to_dict()
 
     return epc, df, concentration_thresholds, averages, epc_averages
 
 
-def clean_equity_data(data: pd.DataFrame) -> pd.DataFrame:
-    data['Age 19 or Under'] = (
-            data['female_under_5'] + data['female_5_to_9'] + data['female_10_to_14'] +
-            data['female_15_to_17'] + data['female_18_and_19'] +
-            data['male_under_5'] + data['male_5_to_9'] + data['male_10_to_14'] +
-            data['male_15_to_17'] + data['male_18_and_19']
-    )
-    data['Age 65 or Over'] = (
-            data['female_65_and_66'] + data['female_67_to_69'] + data['female_70_to_74'] +
-            data['female_75_to_79'] + data['female_80_to_84'] + data['female_85_and_over'] +
-            data['male_65_and_66'] + data['male_67_to_69'] + data['male_70_to_74'] +
-            data['male_75_to_79'] + data['male_80_to_84'] + data['male_85_and_over']
-    )
+def indicator_sources(names: list) -> list:
+    sources = []
+    for name in names:
+        spec = DERIVED_INDICATORS[name]
+        for column in spec['numerator'] + spec.get('subtract', []) + spec.get('denominator', []):
+            columns = indicator_sources([column]) if column in DERIVED_INDICATORS else [column]
+            sources += [x for x in columns if x not in sources]
+    return sources
+
+
+def _evaluate_indicator(name: str, values: np.ndarray, positions: dict, derived: dict) -> np.ndarray:
+    if name not in derived:
+        spec = DERIVED_INDICATORS[name]
+
+        def group_sum(columns: list) -> np.ndarray:
+            total = values[:, [positions[x] for x in columns if x in positions]].sum(axis=1)
+            for column in columns:
+                if column in DERIVED_INDICATORS:
+                    total = total + _evaluate_indicator(column, values, positions, derived)
+            return total
+
+        result = group_sum(spec['numerator'])
+        if spec.get('subtract'):
+            result = result - group_sum(spec['subtract'])
+        if spec.get('denominator'):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = (result / group_sum(spec['denominator'])) * spec.get('scale', 1)
+        derived[name] = result
+    return derived[name]
+
+
+def evaluate_indicators(sources: pd.DataFrame, names: tuple) -> pd.DataFrame:
+    # sources: the indicator_sources(names) columns of a census tract frame
+    values = sources.to_numpy()
+    if values.dtype == object:
+        values = values.astype('float64')
+    positions = {column: i for i, column in enumerate(sources.columns)}
+    derived = {}
+    return pd.DataFrame({name: _evaluate_indicator(name, values, positions, derived) for name in names},
+                        index=sources.index)
+
+
+def add_indicators(data: pd.DataFrame, names: list) -> pd.DataFrame:
+    indicators = evaluate_indicators(data[indicator_sources(names)], tuple(names))
+    for name in names:
+        data[name] = indicators[name].to_numpy()
+    return data
 
-    data.rename({'below_pov_level': 'Below Poverty Level', '200_below_pov_level': '200% Below Poverty Level'}, axis=1,
-                inplace=True)
 
-    data['total_w_a_disability'] = (data['male_under_5_w_a_disability'] + data['male_5_to_17_w_a_disability'] + data[
-        'male_18_to_34_w_a_disability'] +
-                                    data['male_35_to_64_w_a_disability'] + data['male_65_to_74_w_a_disability'] + data[
-                                        'male_75_and_over_w_a_disability'] +
-                                    data['female_under_5_w_a_disability'] + data['female_5_to_17_w_a_disability'] +
-                                    data['female_18_to_34_w_a_disability'] +
-                                    data['female_35_to_64_w_a_disability'] + data['female_65_to_74_w_a_disability'] +
-                                    data['female_75_and_over_w_a_disability']
-                                    )
-
-    data['speak_eng_not_well'] = (
-            data['foreign_speak_spanish_speak_eng_not_well'] + data['foreign_speak_spanish_speak_eng_not_at_all'] +
-            data['foreign_speak_other_indo-euro_speak_eng_not_well'] + data[
-                'foreign_speak_other_indo-euro_speak_eng_not_at_all'] +
-            data['foreign_speak_asian_or_pac_isl_lang_speak_eng_not_well'] + data[
-                'foreign_speak_asian_or_pac_isl_lang_speak_eng_not_at_all'] +
-            data['foreign_speak_other_speak_eng_not_well'] + data['foreign_speak_other_speak_eng_not_at_all']
-    )
+def shared_indicators(data: pd.DataFrame) -> pd.DataFrame:
+    """Evaluates SHARED_INDICATORS once for a census tract frame, to pass to both clean_equity_data and
+    clean_transport_data.
+    in:  census tract frame with a 'Census Tract' column and the indicator_sources(SHARED_INDICATORS) columns
+    out: SHARED_INDICATORS indexed by Census Tract
+    """
+    indicators = evaluate_indicators(data[indicator_sources(SHARED_INDICATORS)], tuple(SHARED_INDICATORS))
+    indicators.index = data['Census Tract'].to_numpy()
+    return indicators
+
+
+def add_shared_indicators(data: pd.DataFrame, shared: pd.DataFrame = None) -> pd.DataFrame:
+    # Frames with tracts the shared indicators don't cover evaluate their own
+    if shared is None or not shared.index.is_unique or not data['Census Tract'].isin(shared.index).all():
+        shared = shared_indicators(data)
+    shared = shared.loc[data['Census Tract'].to_numpy()]
+    for name in SHARED_INDICATORS:
+        data[name] = shared[name].to_numpy()
+    return data
 
-    data['single_parent'] = data['other_male_householder_no_spouse_w_kids'] + data[
-        'other_female_householder_no_spouse_w_kids']
 
-    data['non-white'] = data['total_population'] - data['not_hisp_or_latino_white']
+def clean_equity_data(data: pd.DataFrame, shared: pd.DataFrame = None) -> pd.DataFrame:
+    data = add_shared_indicators(data, shared)
+    data = add_indicators(data, ['total_w_a_disability', 'People with Disability (%)'])
 
-    data['People with Disability (%)'] = data['total_w_a_disability'] / (data['male'] + data['female'])
-    data['200% Below Poverty Level (%)'] = data['200% Below Poverty Level'] / data[
-        'population_for_whom_poverty_status_is_determined']
-    data['Age 19 or Under (%)'] = data['Age 19 or Under'] / data['total_population']
-    data['Age 65 or Over (%)'] = data['Age 65 or Over'] / data['total_population']
-    data['Limited English Proficiency (%)'] = data['speak_eng_not_well'] / (data['native'] + data['foreign_born'])
-    data['Single Parent Family (%)'] = data['single_parent'] / data['total_families']
-    data['Zero-Vehicle Household (%)'] = data['percent_hh_0_veh']
-    data['People of Color (%)'] = data['non-white'] / data['total_population']
+    data.rename({'below_pov_level': 'Below Poverty Level', '200_below_pov_level': '200% Below Poverty Level'}, axis=1,
+                inplace=True)
+    data['Zero-Vehicle Household (%)'] = data['percent_hh_0_veh'] * 100
 
     for header in (EQUITY_CENSUS_POC_LOW_INCOME + EQUITY_CENSUS_REMAINING_HEADERS):
-        data[header + ' (%)'] = round(data[header + ' (%)'] * 100)
+        data[header + ' (%)'] = round(data[header + ' (%)'])
 
     data['criteria_A'] = 0
     data['criteria_B'] = 0
@@ -869,46 +1100,13 @@ def clean_equity_data(data: pd.DataFrame) -> pd.DataFrame:
     return data
 
 
-def clean_transport_data(data: pd.DataFrame, epc: pd.DataFrame) -> pd.DataFrame:
+def clean_transport_data(data: pd.DataFrame, epc: pd.DataFrame, shared: pd.DataFrame = None) -> pd.DataFrame:
     # data['walkability_index'] = round(data['walkability_index'])
     data['number_drive_alone'] = data['percent_drive_alone'] * data['total_workers_commute']
     data.drop(['total_workers_commute'], axis=1, inplace=True)
 
-    data['non-white'] = data['total_population'] - data['not_hisp_or_latino_white']
-    data['People of Color (%)'] = 100 * (data['non-white'] / data['total_population'])
-    data['No Computer Households (%)'] = 100 * (data['household_no_computing_device'] / (
-                data['household_no_computing_device'] + data['household_computer'] + data[
-            'household_smartphone_no_computer'] + data['household_no_internet'] + data['household_broadband']))
-    data['200% Below Poverty Level (%)'] = 100 * (
-                data['200_below_pov_level'] / data['population_for_whom_poverty_status_is_determined'])
-    data['Renter Occupied Units (%)'] = 100 * (data['renter-occ_units'] / data['occupied_housing_units'])
-    data['Age 19 or Under'] = (
-            data['female_under_5'] + data['female_5_to_9'] + data['female_10_to_14'] +
-            data['female_15_to_17'] + data['female_18_and_19'] +
-            data['male_under_5'] + data['male_5_to_9'] + data['male_10_to_14'] +
-            data['male_15_to_17'] + data['male_18_and_19']
-    )
-    data['Age 19 or Under (%)'] = 100 * (data['Age 19 or Under'] / data['total_population'])
-    data['Age 65 or Over'] = (
-            data['female_65_and_66'] + data['female_67_to_69'] + data['female_70_to_74'] +
-            data['female_75_to_79'] + data['female_80_to_84'] + data['female_85_and_over'] +
-            data['male_65_and_66'] + data['male_67_to_69'] + data['male_70_to_74'] +
-            data['male_75_to_79'] + data['male_80_to_84'] + data['male_85_and_over']
-    )
-    data['Age 65 or Over (%)'] = 100 * (data['Age 65 or Over'] / data['total_population'])
-    data['speak_eng_not_well'] = (
-            data['foreign_speak_spanish_speak_eng_not_well'] + data['foreign_speak_spanish_speak_eng_not_at_all'] +
-            data['foreign_speak_other_indo-euro_speak_eng_not_well'] + data[
-                'foreign_speak_other_indo-euro_speak_eng_not_at_all'] +
-            data['foreign_speak_asian_or_pac_isl_lang_speak_eng_not_well'] + data[
-                'foreign_speak_asian_or_pac_isl_lang_speak_eng_not_at_all'] +
-            data['foreign_speak_other_speak_eng_not_well'] + data['foreign_speak_other_speak_eng_not_at_all']
-    )
-    data['Limited English Proficiency (%)'] = 100 * (
-                data['speak_eng_not_well'] / (data['native'] + data['foreign_born']))
-    data['single_parent'] = data['other_male_householder_no_spouse_w_kids'] + data[
-        'other_female_householder_no_spouse_w_kids']
-    data['Single Parent Family (%)'] = 100 * (data['single_parent'] / data['total_families'])
+    data = add_shared_indicators(data, shared)
+    data = add_indicators(data, ['No Computer Households (%)', 'Renter Occupied Units (%)'])
 
     data.rename({
         'percent_hh_0_veh': 'Zero-Vehicle Households (%)',
@@ -1007,24 +1205,24 @@ def get_county_data(state: str, county_ids: list = None, policy: bool = False):
     return df
 
 
+def national_shard(states: list) -> pd.DataFrame:
+    return pd.concat([get_county_data(s) for s in states])
+
+
 @st.experimental_memo(ttl=3600)
-def get_national_county_data() -> pd.DataFrame:
-    frames = []
-    for s in STATES:
-        tmp_df = get_county_data(s)
-        frames.append(tmp_df)
-    df = pd.concat(frames)
-    return df
+def get_national_county_data(workers: int = None) -> pd.DataFrame:
+    # States are fetched and cleaned in parallel worker processes, then concatenated in STATES order. The workers
+    # don't share the per-state get_county_data memo, so the whole result is memoized here
+    return pd.concat(utils.map_partitioned(national_shard, STATES, workers))
+
+
+def national_geoms_shard(states: list, counties: list) -> pd.DataFrame:
+    return pd.concat([get_county_geoms(counties, s) for s in states])
 
 
 @st.experimental_memo(ttl=3600)
-def get_national_county_geom_data(counties: list) -> pd.DataFrame:
-    frames = []
-    for c in counties:
-        tmp_df = get_county_geoms()
-        frames.append(tmp_df)
-    df = pd.concat(frames)
-    return df
+def get_national_county_geom_data(counties: list, workers: int = None) -> pd.DataFrame:
+    return pd.concat(utils.map_partitioned(national_geoms_shard, STATES, workers, counties=counties))
 
 
 def test_new_counties():
@@ -0,0 +1,135 @@
+import io
+import os
+import pandas as pd
+
+import queries
+from constants import STATE_ABBREVIATIONS
+
+# Longest first, so 'city and borough' is removed whole rather than just 'borough'
+COUNTY_SUFFIXES = ['city and borough', 'census area', 'municipality', 'municipio', 'borough', 'parish', 'county']
+
+
+def canonical_state(states: pd.Series) -> pd.Series:
+    # Two letter abbreviations become full names, then everything is lowercased
+    states = states.astype(str).str.strip()
+    return states.str.upper().map(STATE_ABBREVIATIONS).fillna(states).str.lower()
+
+
+def canonical_county(counties: pd.Series) -> pd.Series:
+    counties = (counties.astype(str)
+                .str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+                .str.lower()
+                .str.replace(r"[.']", '', regex=True)
+                .str.replace(r'[^a-z0-9]+', ' ', regex=True)
+                .str.replace(r'\bsaint\b', 'st', regex=True)
+                .str.replace(r'\bsainte\b', 'ste', regex=True))
+    return counties.str.strip()
+
+
+def strip_suffix(counties: pd.Series) -> pd.Series:
+    return counties.str.replace(r' (?:' + '|'.join(COUNTY_SUFFIXES) + r')$', '', regex=True)
+
+
+def _unique_lookup(keys: pd.Series, ids: pd.Series) -> pd.Series:
+    # Keys that point at more than one county_id are ambiguous and left out
+    pairs = pd.DataFrame({'key': keys.to_numpy(), 'county_id': ids.to_numpy()}).drop_duplicates()
+    return pairs.drop_duplicates('key', keep=False).set_index('key')['county_id']
+
+
+def county_lookup(counties: pd.DataFrame = None) -> tuple:
+    """Builds the hash lookups used to resolve county names to ids.
+    in:  id_index counties (queries.all_counties_query() by default)
+    out: lookup by canonical 'state|county' key, lookup by the same key without suffixes like 'County' or 'Parish'
+    """
+    if counties is None:
+        counties = queries.all_counties_query()
+    states = canonical_state(counties['state_name'])
+    names = canonical_county(counties['county_name'])
+    return (_unique_lookup(states + '|' + names, counties['county_id']),
+            _unique_lookup(states + '|' + strip_suffix(names), counties['county_id']))
+
+
+def resolve_county_ids(df: pd.DataFrame, state_col: str, county_col: str, id_col: str = 'county_id',
+                       lookups: tuple = None, overwrite: bool = False) -> tuple:
+    """Fills in county ids for a whole table with two hash joins: on the canonical name, then on the name
+    without its suffix.
+    in:  table, its state and county name columns, the id column to fill, lookups from county_lookup,
+         whether to re-resolve rows that already have an id
+    out: table with ids filled in, rows that could not be matched
+    """
+    exact, loose = lookups if lookups is not None else county_lookup()
+    df = df.copy()
+    if id_col not in df.columns:
+        df[id_col] = None
+    target = df.index[df[id_col].isnull()] if not overwrite else df.index
+
+    states = canonical_state(df.loc[target, state_col])
+    names = canonical_county(df.loc[target, county_col])
+    ids = (states + '|' + names).map(exact)
+    missing = ids.isnull()
+    ids[missing] = (states[missing] + '|' + strip_suffix(names[missing])).map(loose)
+
+    resolved = ids.notnull()
+    df.loc[ids.index[resolved], id_col] = ids[resolved]
+    return df, df.loc[ids.index[~resolved], [state_col, county_col]]
+
+
+def update_county_ids(table: str, resolved: pd.DataFrame, state_col: str, county_col: str,
+                      id_col: str = 'county_id') -> int:
+    """Fills in missing ids in place with one UPDATE from a staged table of resolved names, so the table keeps its
+    indexes, constraints and column types.
+    in:  table, distinct (state, county, id) rows resolved by resolve_county_ids, the table's name and id columns
+    out: number of rows updated
+    """
+    resolved = resolved[[state_col, county_col, id_col]].drop_duplicates()
+    if resolved[id_col].dtype.kind == 'f':
+        # Ids are read back as floats when some rows are missing them
+        resolved[id_col] = resolved[id_col].astype('Int64')
+    conn = queries.init_connection()
+    cur = conn.cursor()
+    cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "{id_col}" text;')
+    # The staging table copies the target's column types, so the update needs no casts
+    cur.execute(f"""CREATE TEMP TABLE {table}_ids ON COMMIT DROP AS
+        SELECT "{state_col}", "{county_col}", "{id_col}" FROM {table} WITH NO DATA;""")
+    buf = io.StringIO()
+    resolved.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f'COPY {table}_ids FROM STDIN WITH (FORMAT csv)', buf)
+    cur.execute(f"""
+        UPDATE {table} t SET "{id_col}" = s."{id_col}" FROM {table}_ids s
+        WHERE t."{state_col}" = s."{state_col}" AND t."{county_col}" = s."{county_col}" AND t."{id_col}" IS NULL;""")
+    updated = cur.rowcount
+    conn.commit()
+    return updated
+
+
+def reconcile_table(table: str, state_col: str, county_col: str, id_col: str = 'county_id',
+                    lookups: tuple = None, write: bool = True) -> pd.DataFrame:
+    df = queries.read_table(table)
+    missing = df[id_col].isnull() if id_col in df.columns else pd.Series(True, index=df.index)
+    df, unmatched = resolve_county_ids(df, state_col, county_col, id_col, lookups)
+    resolved = df.loc[missing & df[id_col].notnull()]
+    if write and len(resolved) > 0:
+        update_county_ids(table, resolved, state_col, county_col, id_col)
+    print(f'{table}: {len(resolved)} ids filled, {len(unmatched)} unmatched')
+    return unmatched
+
+
+def reconcile_tables(tables: dict, path: str = 'Output/unmatched_counties.csv', write: bool = True) -> pd.DataFrame:
+    """Resolves county ids across several tables with one set of lookups and reports every unmatched row together.
+    in:  dict of table -> (state column, county column), where to write the unmatched report, whether to write
+         the tables back
+    out: unmatched rows of every table
+    """
+    lookups = county_lookup()
+    frames = []
+    for table, (state_col, county_col) in tables.items():
+        unmatched = reconcile_table(table, state_col, county_col, lookups=lookups, write=write)
+        frames.append(pd.DataFrame({'table': table, 'state': unmatched[state_col].to_numpy(),
+                                    'county': unmatched[county_col].to_numpy()}))
+    report = pd.concat(frames, ignore_index=True)
+    if not report.empty:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        report.to_csv(path, index=False)
+        print(f'{len(report)} unmatched rows written to {path}')
+    return report
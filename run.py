@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import streamlit as st
 
@@ -8,7 +9,7 @@ import equity_explorer
 import queries
 import analysis
 import utils
-from constants import STATES
+import cli
 
 # Pandas options
 pd.options.display.max_rows = 25
@@ -23,18 +24,18 @@ PAGES = [
     'Eviction Analysis'
 ]
 
-def print_summary(df: pd.DataFrame, output: str):
+def print_summary(df: pd.DataFrame, output: str, rankings: str = None):
     print('*** Results ***')
     if 'Rank' in df.columns:
         print('* Shown in order by overall priority, higher values mean higher priority.')
         df.sort_values('Rank', ascending=False, inplace=True)
         print(df['Rank'])
-        print('Normalized analysis data is located at {o}'.format(o=output[:-5]) + '_overall_vulnerability.xlsx')
+        print('Normalized analysis data is located at {o}'.format(o=rankings))
     elif len(df) > 1:
         print('* Shown in order by relative risk, higher values mean higher relative risk.')
         df.sort_values('Relative Risk', ascending=False, inplace=True)
         print(df['Relative Risk'])
-        print('Normalized analysis data is located at {o}'.format(o=output[:-5]) + '_overall_vulnerability.xlsx')
+        print('Normalized analysis data is located at {o}'.format(o=rankings))
     else:
         print('Fetched single county data')
 
@@ -42,7 +43,16 @@ def print_summary(df: pd.DataFrame, output: str):
     print('Done!')
 
 
+def output_path(name: str, file_format: str) -> str:
+    return utils.export_file_name('Output/' + name, file_format)
+
+
 def run_shell() -> pd.DataFrame:
+    args = {k: v for k, v in [i.split('=') for i in sys.argv[1:] if '=' in i]}
+    file_format = args.get('--format', 'xlsx')
+    if file_format not in utils.EXPORT_FORMATS:
+        raise Exception(f"INVALID FORMAT! Use one of: {', '.join(utils.EXPORT_FORMATS)}")
+
     task = input(
         'Analyze a single county (1), multiple counties (2), all the counties in a state (3), or a nation-wide analysis (4)? [default: 1]') \
         .strip()
@@ -57,10 +67,11 @@ def run_shell() -> pd.DataFrame:
         df = queries.get_county_data(state, [county])
 
         if cost_of_evictions == 'y' or cost_of_evictions == '':
-            df = analysis.calculate_cost_estimate(df, rent_type='fmr')
+            df = cli.estimate_cost(df, cli.COST_DEFAULTS)
 
-        utils.output_table(df, 'Output/' + county.capitalize() + '.xlsx')
-        print_summary(df, 'Output/' + county.capitalize() + '.xlsx')
+        path = output_path(county.capitalize(), file_format)
+        utils.output_table(df, path, file_format)
+        print_summary(df, path)
         return df
     elif task == '2':
         state = input("Which state are you looking for? (ie: California)").strip()
@@ -69,11 +80,13 @@ def run_shell() -> pd.DataFrame:
         cost_of_evictions = input(
             'Run an analysis to estimate the cost to avoid evictions? (Y/n) ')
         if cost_of_evictions == 'y' or cost_of_evictions == '':
-            df = analysis.calculate_cost_estimate(df, rent_type='fmr')
+            df = cli.estimate_cost(df, cli.COST_DEFAULTS)
 
-        utils.output_table(df, 'Output/' + state + '_selected_counties.xlsx')
-        analysis_df = analysis.rank_counties(df, state + '_selected_counties')
-        print_summary(analysis_df, 'Output/' + state + '_selected_counties.xlsx')
+        path = output_path(state + '_selected_counties', file_format)
+        utils.output_table(df, path, file_format)
+        analysis_df = analysis.rank_counties(df)
+        rankings = analysis.export_rankings(analysis_df, state + '_selected_counties', file_format)
+        print_summary(analysis_df, path, rankings)
         return df
     elif task == '3':
         state = input("Which state are you looking for? (ie: California)").strip()
@@ -81,11 +94,13 @@ def run_shell() -> pd.DataFrame:
         cost_of_evictions = input(
             'Run an analysis to estimate the cost to avoid evictions? (Y/n) ')
         if cost_of_evictions == 'y' or cost_of_evictions == '':
-            df = analysis.calculate_cost_estimate(df, rent_type='fmr')
+            df = cli.estimate_cost(df, cli.COST_DEFAULTS)
 
-        utils.output_table(df, 'Output/' + state + '.xlsx')
-        analysis_df = analysis.rank_counties(df, state)
-        print_summary(analysis_df, 'Output/' + state + '.xlsx')
+        path = output_path(state, file_format)
+        utils.output_table(df, path, file_format)
+        analysis_df = analysis.rank_counties(df)
+        rankings = analysis.export_rankings(analysis_df, state, file_format)
+        print_summary(analysis_df, path, rankings)
         temp = df.copy()
         temp.reset_index(inplace=True)
         counties = temp['County Name'].to_list()
@@ -93,20 +108,16 @@ def run_shell() -> pd.DataFrame:
         df = df.merge(geom, on='County Name', how='outer')
         return df
     elif task == '4':
-        frames = []
-        for state in STATES:
-            df = queries.get_county_data(state)
-            frames.append(df)
-        natl_df = pd.concat(frames)
         cost_of_evictions = input(
             'Run an analysis to estimate the cost to avoid evictions (Y/n) ')
-        if cost_of_evictions == 'y' or cost_of_evictions == '':
-            df = analysis.calculate_cost_estimate(natl_df, rent_type='fmr')
 
-        utils.output_table(natl_df, 'Output/US_national.xlsx')
-        analysis_df = analysis.rank_counties(natl_df, 'US_national')
-        print_summary(analysis_df, 'Output/US_national.xlsx')
-        return df
+        path = output_path('US_national', file_format)
+        cost = cli.COST_DEFAULTS if cost_of_evictions == 'y' or cost_of_evictions == '' else None
+        natl_df, features = cli.stream_national(path, file_format, cost=cost)
+        analysis_df = analysis.rank_counties(natl_df, precomputed=features)
+        rankings = analysis.export_rankings(analysis_df, 'US_national', file_format)
+        print_summary(analysis_df, path, rankings)
+        return analysis_df
     else:
         raise Exception('INVALID INPUT! Enter a valid task number.')
 
@@ -153,6 +164,8 @@ def run_UI():
         page=st.sidebar.radio('Navigation', PAGES, index=st.session_state.page)
     else:
         page=st.sidebar.radio('Navigation', PAGES, index=1)
+    st.session_state.download_format = st.sidebar.selectbox('Download format', list(utils.EXPORT_FORMATS),
+                                                            format_func=lambda x: utils.EXPORT_FORMATS[x])
 
     st.experimental_set_query_params(page=page)
 
@@ -217,6 +230,9 @@ if __name__ == '__main__':
             st.session_state['data_format'  ] = 'Raw Values'
             st.session_state['loaded'] = False
 
+        queries.clear_stale_caches()
         run_UI()
+    elif set(sys.argv[1:]) & set(cli.COMMANDS) or any(a.startswith('--jobs') for a in sys.argv[1:]):
+        cli.main([a for a in sys.argv[1:] if a not in ('--mode', 'script', '--mode=script')])
     else:
         run_shell()
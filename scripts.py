@@ -1,9 +1,16 @@
+import io
 import queries
+import reconcile
+import utils
 import pandas as pd
 import geopandas as gpd
+from shapely import wkb
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from sqlalchemy import create_engine
 import psycopg2
 import credentials
+from constants import STATES
 
 
 def init_engine():
@@ -13,18 +20,7 @@ def init_engine():
 
 
 def fix_chmura_counties():
-    counties = queries.all_counties_query()
-    counties.set_index(['State', 'County Name'], inplace=True)
-    ch_df = queries.generic_select_query('chmura_economic_vulnerability_index',
-                                         ['fips', 'name', 'VulnerabilityIndex', 'Rank', 'state', 'county_id'])
-    for i, row in ch_df.iterrows():
-        if pd.isnull(row['county_id']):
-            try:
-                ch_df.at[i, 'county_id'] = counties.loc[row['state'], row['name']]['county_id']
-            except KeyError:
-                print(row['state'], row['name'])
-
-    queries.write_table(ch_df, 'chmura_economic_vulnerability_index')
+    reconcile.reconcile_tables({'chmura_economic_vulnerability_index': ('state', 'name')})
 
 
 def populate_table(path: str, name: str):
@@ -61,58 +57,234 @@ FRED_TABLES = [
 ]
 
 
+FRED_KEEP_COLUMNS = ['date', 'value', 'fips', 'state_name', 'county_name', 'rent50_0', 'rent50_1', 'rent50_2',
+                     'rent50_3', 'rent50_4', 'pop2017', 'hu2017', 'fmr_0', 'fmr_1', 'fmr_2', 'fmr_3', 'fmr_4',
+                     'fmr_pct_chg', 'fmr_dollar_chg']
+
+FRED_KEY = ['county_id', 'date']
+
+WATERMARK_TABLE = queries.FRED_WATERMARK_TABLE
+
+
+def fred_rows(table: str, ch_df: pd.DataFrame, where: str = None) -> pd.DataFrame:
+    df = queries.read_table(table, where=where).merge(ch_df, on='county_id', suffixes=('_DROP', ''))
+    df = df[[c for c in FRED_KEEP_COLUMNS if c in df.columns]]
+    return df.replace({'.': None}).rename({"value": table, 'fips': 'county_id'}, axis=1)
+
+
 def update_FRED():
     engine = init_engine()
-    ch_df = queries.read_table('chmura_economic_vulnerability_index')
-    keep_cols = {'date', 'value', 'fips', 'state_name', 'county_name', 'rent50_0', 'rent50_1',
-                 'rent50_2', 'rent50_3', 'rent50_4', 'pop2017', 'hu2017', 'fmr_0', 'fmr_1', 'fmr_2',
-                 'fmr_3', 'fmr_4', 'pop2017', 'fmr_pct_chg', 'fmr_dollar_chg'}
-    big_df = pd.DataFrame()
-    frames = []
+    ch_df = queries.read_table('chmura_economic_vulnerability_index', columns=['county_id', 'fips'])
     for table in FRED_TABLES:
-        df = queries.read_table(table)
-        df = df.merge(ch_df, on='county_id')
-        print(df.columns)
-        drop_cols = list(set(df.columns) - keep_cols)
-        df.drop(drop_cols, axis=1, inplace=True)
-        df.replace('.', None, inplace=True)
-        df.rename({"value": table, 'fips': 'county_id'}, axis=1, inplace=True)
-        # df.to_csv('temp/temp.csv')
+        df = fred_rows(table, ch_df)
         df.to_sql(f"{table}_new", engine, if_exists='replace', method='multi', index=False)
-        print(df.head())
+        print(table, df.shape)
+
+
+def table_exists(cur, table: str) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    return cur.fetchone()[0]
+
+
+def ensure_watermarks(cur):
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        table_name text PRIMARY KEY, max_date text, rows_loaded bigint, refreshed_at timestamptz DEFAULT now());""")
+
+
+def dedupe_keys(cur, table: str):
+    # Tables loaded by update_FRED have no key constraint, so repeated (county_id, date) rows are reported and only
+    # the last one written is kept before the unique index is built
+    cur.execute(f"""
+        SELECT county_id, date, count(*) FROM {table}
+        GROUP BY county_id, date HAVING count(*) > 1 ORDER BY county_id, date;""")
+    duplicates = cur.fetchall()
+    if not duplicates:
+        return
+    print(f'{table}: {len(duplicates)} (county_id, date) keys have more than one row, e.g. {duplicates[:5]}')
+    cur.execute(f"""
+        DELETE FROM {table} a USING {table} b
+        WHERE a.county_id = b.county_id AND a.date = b.date AND a.ctid < b.ctid;""")
+    print(f'{table}: removed {cur.rowcount} duplicate rows')
+
+
+def dependent_views(cur, table: str) -> list:
+    # Materialized views whose definitions read from the table
+    cur.execute("""
+        SELECT DISTINCT v.oid::regclass::text
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE v.relkind = 'm' AND d.refobjid = to_regclass(%s);""", (table,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def refresh_FRED_table(conn, table: str, ch_df: pd.DataFrame, batch_size: int = 50000) -> int:
+    """Upserts the (county_id, date) observations of a FRED table that {table}_new does not have yet, including
+    late observations for earlier dates, and records the load in the watermark table.
+    in:  connection, source table, chmura county ids and fips, rows per staged batch
+    out: number of rows upserted
+    """
+    target = f'{table}_new'
+    cur = conn.cursor()
+    ensure_watermarks(cur)
+    where = None
+    if table_exists(cur, target):
+        # Anti-join on the target's keys; the target stores chmura's fips as its county_id
+        where = f"""NOT EXISTS (
+            SELECT 1 FROM {target} t
+            JOIN chmura_economic_vulnerability_index c ON c.fips::text = t.county_id::text
+            WHERE c.county_id = {table}.county_id AND t.date = {table}.date)"""
+    df = fred_rows(table, ch_df, where=where)
+    if df.empty:
+        print(f'{table}: up to date')
+        conn.commit()
+        return 0
+
+    if not table_exists(cur, target):
+        conn.commit()
+        df.head(0).to_sql(target, init_engine(), index=False)
+    if not table_exists(cur, f'{target}_county_date'):
+        dedupe_keys(cur, target)
+        cur.execute(f"CREATE UNIQUE INDEX {target}_county_date ON {target} (county_id, date);")
+
+    # Batches are copied into a staging table and merged, so one statement never holds the whole refresh
+    columns = ', '.join(f'"{c}"' for c in df.columns)
+    updates = ', '.join(f'"{c}" = EXCLUDED."{c}"' for c in df.columns if c not in FRED_KEY)
+    cur.execute(f"CREATE TEMP TABLE {target}_stage (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP;")
+    for start in range(0, len(df), batch_size):
+        copy_table(cur, df.iloc[start:start + batch_size], f'{target}_stage')
+        cur.execute(f"""
+            INSERT INTO {target} ({columns})
+            SELECT DISTINCT ON (county_id, date) {columns} FROM {target}_stage
+            ON CONFLICT (county_id, date) DO {'UPDATE SET ' + updates if updates else 'NOTHING'};
+            TRUNCATE {target}_stage;""")
+
+    cur.execute(f"""
+        INSERT INTO {WATERMARK_TABLE} (table_name, max_date, rows_loaded, refreshed_at)
+        VALUES (%s, (SELECT max(date)::text FROM {target}), %s, now())
+        ON CONFLICT (table_name) DO UPDATE SET max_date = EXCLUDED.max_date, rows_loaded = EXCLUDED.rows_loaded,
+            refreshed_at = EXCLUDED.refreshed_at;""", (table, len(df)))
+    conn.commit()
+    print(f'{table}: {len(df)} rows upserted into {target}')
+    return len(df)
 
 
-def map_ntm():
+def refresh_FRED(tables: list = None, batch_size: int = 50000) -> dict:
+    """Incremental alternative to update_FRED: only observations missing from each {table}_new are read and
+    upserted, then materialized views built on the refreshed tables are refreshed. The app clears its cached queries
+    when it sees the new refreshed_at in the watermark table (queries.clear_stale_caches).
+    """
     conn = queries.init_connection()
-    query = """
-    SELECT a.route_type_text, a.route_long_name, a.route_desc,a.length, a.geom, b.tract_id
-    FROM ntm_shapes a, census_tracts_geom b, id_index c
-    WHERE ST_Intersects(a.geom, b.geom);
+    ch_df = queries.read_table('chmura_economic_vulnerability_index', columns=['county_id', 'fips'])
+    loaded = {table: refresh_FRED_table(conn, table, ch_df, batch_size) for table in tables or FRED_TABLES}
+
+    cur = conn.cursor()
+    views = []
+    for table in [t for t, rows in loaded.items() if rows]:
+        views += [v for v in dependent_views(cur, f'{table}_new') if v not in views]
+    for view in views:
+        cur.execute(f'REFRESH MATERIALIZED VIEW {view};')
+        print(f'refreshed {view}')
+    conn.commit()
+    conn.close()
+    return loaded
+
+
+# Source table -> (attribute columns, how a feature is matched to a tract)
+NTM_LAYERS = {
+    'ntm_shapes': (['route_type_text', 'route_long_name', 'route_desc', 'length'], 'intersects'),
+    'ntm_stops': (['stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding', 'direction'], 'covered_by'),
+}
+
+SQL_TYPES = {'f': 'double precision', 'i': 'bigint', 'u': 'bigint', 'b': 'boolean'}
+
+
+def read_geoms(cur, query: str, params: tuple = None) -> pd.DataFrame:
+    # Geometries come back as WKB so they can be parsed with shapely, here or in a worker process
+    cur.execute(query, params)
+    df = pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+    df['geom'] = [wkb.loads(bytes(g)) for g in df['geom']]
+    return df
+
+
+def assign_tracts(states: list, table: str, columns: list, predicate: str, srid: int) -> pd.DataFrame:
+    """Spatially joins the features of a table to the census tracts of a partition of states.
+    in:  states in the partition, source table, attribute columns to keep, 'intersects' or 'covered_by', SRID
+    out: one row per feature and tract it falls in, with the geometry as hex EWKB for bulk loading
     """
-    #     query="""
-    # SELECT a.stop_name, a.stop_lat, a.stop_lon, a.wheelchair_boarding,a.direction, a.geom, b.tract_id
-    # FROM ntm_stops a, census_tracts_geom b
-    # WHERE ST_CoveredBy(a.geom, b.geom);
-    #     """
-
-    # df = pd.read_sql(query, con=conn)
-    # df.to_csv('temp/new_ntm_shapes.csv')
-    df=pd.read_csv('temp/new_ntm_shapes.csv',low_memory=False)
-    # df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    print(df.shape)
-    print(df.dtypes)
-    print(df.describe())
+    conn = queries.init_connection()
+    cur = conn.cursor()
+    tracts = read_geoms(cur, """
+        SELECT b.tract_id, ST_AsBinary(b.geom) AS geom
+        FROM census_tracts_geom b
+        INNER JOIN id_index c ON b.tract_id = c.tract_id
+        WHERE c.state_name IN %s;""", (tuple(states),))
+    if tracts.empty:
+        conn.close()
+        return pd.DataFrame(columns=columns + ['tract_id', 'geom'])
 
-    # df.drop(['OBJECTID'], inplace=True, axis=1)
-    # df.replace('N', None, inplace=True)
-    engine = init_engine()
-    df.to_sql('ntm_shapes_new', engine, if_exists='replace', method='multi', index=False)
-    print('write complete')
+    # Only features in the partition's bounding box are fetched, using the table's spatial index
+    bounds = gpd.GeoSeries(tracts['geom']).total_bounds
+    features = read_geoms(cur, f"""
+        SELECT {', '.join(columns)}, ST_AsBinary(geom) AS geom FROM {table}
+        WHERE geom && ST_MakeEnvelope(%s, %s, %s, %s, %s);""", tuple(bounds) + (srid,))
+    conn.close()
+
+    # R-tree over the tracts; candidates from the bounding box query are confirmed with the exact predicate
+    geoms = list(tracts['geom'])
+    tree = STRtree(geoms, range(len(geoms)))
+    rows, tract_ids = [], []
+    for i, geom in enumerate(features['geom']):
+        prepared = prep(geom)
+        for j in tree.query_items(geom):
+            tract = geoms[j]
+            if prepared.intersects(tract) if predicate == 'intersects' else tract.covers(geom):
+                rows.append(i)
+                tract_ids.append(tracts['tract_id'].iat[j])
+
+    df = features.iloc[rows].reset_index(drop=True)
+    df['tract_id'] = tract_ids
+    df['geom'] = [wkb.dumps(g, hex=True, srid=srid) for g in df['geom']]
+    return df
 
-    # df=pd.read_csv('temp/new_ntm_stops.csv')
-    # print(df.shape)
-    # print(df.dtypes)
-    # print(df.describe())
+
+def copy_table(cur, df: pd.DataFrame, table: str, create: bool = False):
+    if create:
+        cols = [f'"{c}" geometry' if c == 'geom' else f'"{c}" {SQL_TYPES.get(df[c].dtype.kind, "text")}'
+                for c in df.columns]
+        cur.execute(f'DROP TABLE IF EXISTS {table}; CREATE TABLE {table} ({", ".join(cols)});')
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    names = ', '.join(f'"{c}"' for c in df.columns)
+    cur.copy_expert(f'COPY {table} ({names}) FROM STDIN WITH (FORMAT csv)', buf)
+
+
+def map_ntm(layers: list = None, workers: int = None):
+    """Rebuilds <layer>_new for each National Transit Map layer, with a row for every tract a route or stop is in.
+    Partitions of states are joined in parallel and each is loaded with COPY as soon as it is ready, in one
+    transaction, so a failed run leaves the previous table in place.
+    """
+    conn = queries.init_connection()
+    cur = conn.cursor()
+    for table in layers or NTM_LAYERS:
+        columns, predicate = NTM_LAYERS[table]
+        cur.execute(f'SELECT ST_SRID(geom) FROM {table} LIMIT 1;')
+        srid = cur.fetchone()[0]
+        rows = 0
+        for df in utils.map_partitioned(assign_tracts, STATES, workers, table=table, columns=columns,
+                                        predicate=predicate, srid=srid):
+            # The first partition with rows sets the column types
+            if rows == 0 and df.empty:
+                continue
+            copy_table(cur, df, f'{table}_new', create=rows == 0)
+            rows += len(df)
+        if rows == 0:
+            copy_table(cur, df, f'{table}_new', create=True)
+        cur.execute(f'CREATE INDEX ON {table}_new USING GIST (geom); CREATE INDEX ON {table}_new (tract_id);')
+        conn.commit()
+        print(f'{table}_new: {rows} rows written')
+    conn.close()
 
 
 if __name__ == '__main__':
@@ -120,5 +292,6 @@ if __name__ == '__main__':
     # import_geojson()
     # populate_table('temp/new_ntm_stops.csv', 'ntm_stops_new')
     # update_FRED()
+    # refresh_FRED()
     map_ntm()
     pass
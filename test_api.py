@@ -0,0 +1,91 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+import api
+
+ROWS = [{'id': i, 'value': i * 10} for i in range(25)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Stands in for an open data API: wrapped records, offset/limit pages, a flaky endpoint and a CSV file
+    flaky_calls = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == '/records':
+            self.send(200, json.dumps({'records': ROWS[:3]}))
+        elif url.path == '/rows':
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', len(ROWS)))
+            self.send(200, json.dumps(ROWS[offset:offset + limit]))
+        elif url.path == '/flaky':
+            StubHandler.flaky_calls += 1
+            if StubHandler.flaky_calls < 3:
+                self.send(503, '')
+            else:
+                self.send(200, json.dumps(ROWS[:1]))
+        elif url.path == '/data.csv':
+            self.send(200, 'id,value\n1,10\n2,20\n', 'text/csv')
+        else:
+            self.send(404, '')
+
+    def send(self, status: int, body: str, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpDataTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.session = api.make_session(retries=3, backoff=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.session.close()
+
+    def test_records_are_unwrapped(self):
+        df = api.get_http_data(self.url + '/records', session=self.session)
+        self.assertEqual(df['id'].tolist(), [0, 1, 2])
+
+    def test_pages_are_fetched_in_order_until_a_short_page(self):
+        df = api.get_paged_http_data(self.url + '/rows', page_size=4, session=self.session, workers=3)
+        self.assertEqual(df['id'].tolist(), list(range(25)))
+
+    def test_many_urls_keep_their_order(self):
+        urls = [self.url + '/rows'] * 3
+        params = [{'offset': 20, 'limit': 2}, {'offset': 0, 'limit': 2}, {'offset': 10, 'limit': 1}]
+        df = api.get_many_http_data(urls, params, session=self.session)
+        self.assertEqual(df['id'].tolist(), [20, 21, 0, 1, 10])
+
+    def test_unavailable_responses_are_retried(self):
+        StubHandler.flaky_calls = 0
+        df = api.get_http_data(self.url + '/flaky', session=self.session)
+        self.assertEqual(StubHandler.flaky_calls, 3)
+        self.assertEqual(df['id'].tolist(), [0])
+
+    def test_missing_pages_return_an_empty_frame(self):
+        self.assertTrue(api.get_http_data(self.url + '/missing', session=self.session).empty)
+
+    def test_remote_files_are_read_through_the_session(self):
+        df = pd.read_csv(api.open_source(self.url + '/data.csv', session=self.session))
+        self.assertEqual(df['value'].tolist(), [10, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
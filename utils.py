@@ -1,10 +1,24 @@
+import os
+import gzip
 import base64
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
 from six import BytesIO
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.parquet as pq
 import geopandas as gpd
 import streamlit as st
 
+from constants import EXTENT_COLUMNS
+
 def to_excel(df: pd.DataFrame):
     output = BytesIO()
     writer = pd.ExcelWriter(output, engine='xlsxwriter')
@@ -14,6 +28,298 @@ def to_excel(df: pd.DataFrame):
     return processed_data
 
 
+def fingerprint(df: pd.DataFrame, geometry: bool = False) -> str:
+    # Geometries are left out unless asked for, since hashing their WKB is slow for large frames
+    data = df.drop(['geom'], axis=1, errors='ignore')
+    try:
+        hashed = pd.util.hash_pandas_object(data, index=True).to_numpy()
+    except TypeError:
+        hashed = pd.util.hash_pandas_object(data.astype(str), index=True).to_numpy()
+    md5 = hashlib.md5(hashed.tobytes() + str(list(df.columns)).encode())
+    if geometry and 'geom' in df.columns:
+        for g in df['geom']:
+            md5.update(b'' if g is None else g.wkb)
+    return md5.hexdigest()
+
+
+def _tabular(df: pd.DataFrame, wkt: bool = False) -> pd.DataFrame:
+    # Geometries are written as WKB (WKT for text formats) so columnar writers can store them
+    if 'geom' in df.columns:
+        df = df.copy()
+        df['geom'] = [None if g is None else (g.wkt if wkt else g.wkb) for g in df['geom']]
+    return df
+
+
+def _geo_frame(df: pd.DataFrame) -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(df.reset_index(), geometry='geom', crs='EPSG:4326')
+
+
+def to_csv(df: pd.DataFrame) -> bytes:
+    return _tabular(df, wkt=True).to_csv().encode()
+
+
+def to_csv_gz(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    _tabular(df, wkt=True).to_csv(output, compression='gzip')
+    return output.getvalue()
+
+
+def to_parquet(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    _tabular(df).to_parquet(output, engine='pyarrow')
+    return output.getvalue()
+
+
+def to_feather(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    # Feather cannot store an index, so it is written as columns
+    _tabular(df).reset_index().to_feather(output)
+    return output.getvalue()
+
+
+def to_geoparquet(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    _geo_frame(df).to_parquet(output)
+    return output.getvalue()
+
+
+def to_flatgeobuf(df: pd.DataFrame) -> bytes:
+    # OGR drivers only write to paths
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.fgb')
+        _geo_frame(df).to_file(path, driver='FlatGeobuf')
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class StreamingExport(object):
+    """Writes a table to a file one chunk at a time, so only the current chunk is held in memory.
+    Parquet chunks become row groups, CSV chunks are appended and xlsx rows go through xlsxwriter's
+    constant_memory mode. Other formats are collected and written on close.
+    Every chunk is aligned to the columns of the first one: columns it lacks are left blank, and a chunk with columns
+    the first one doesn't have raises a ValueError rather than losing them.
+    """
+
+    STREAMING_FORMATS = ['parquet', 'csv', 'csv.gz', 'xlsx']
+
+    def __init__(self, path: str, file_format: str = 'parquet'):
+        self.path = path
+        self.file_format = file_format
+        self.columns = None
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, df: pd.DataFrame):
+        if self.file_format not in self.STREAMING_FORMATS:
+            self._chunks.append(df)
+            return
+        df = _tabular(df, wkt=self.file_format != 'parquet').reset_index()
+        if self.columns is None:
+            self.columns = list(df.columns)
+        extra = [c for c in df.columns if c not in self.columns]
+        if extra:
+            raise ValueError(f'{self.path}: chunk has columns not in the first chunk: {", ".join(map(str, extra))}')
+        missing = [c for c in self.columns if c not in df.columns]
+        if missing:
+            print(f'{self.path}: chunk is missing columns, left blank: {", ".join(map(str, missing))}')
+        df = df.reindex(columns=self.columns)
+
+        if self.file_format == 'parquet':
+            self._write_parquet(df)
+        elif self.file_format == 'xlsx':
+            self._write_xlsx(df)
+        else:
+            if self._writer is None:
+                self._writer = gzip.open(self.path, 'wt', newline='') if self.file_format == 'csv.gz' \
+                    else open(self.path, 'w', newline='')
+            df.to_csv(self._writer, header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def _write_parquet(self, df: pd.DataFrame):
+        if self._schema is None:
+            # Integers stay int64 and floats float64, so later chunks' missing values are stored as nulls
+            fields = []
+            for field in pa.Schema.from_pandas(df, preserve_index=False):
+                if pa.types.is_integer(field.type):
+                    field = pa.field(field.name, pa.int64())
+                elif pa.types.is_floating(field.type):
+                    field = pa.field(field.name, pa.float64())
+                elif pa.types.is_null(field.type):
+                    field = pa.field(field.name, pa.string())
+                fields.append(field)
+            self._schema = pa.schema(fields)
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        df = df.copy()
+        for field in self._schema:
+            if pa.types.is_integer(field.type) and not pd.api.types.is_integer_dtype(df[field.name]):
+                # Whole numbers read as float64 because of missing values are cast back to nullable integers
+                df[field.name] = df[field.name].astype('Int64')
+        self._writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+
+    def _write_xlsx(self, df: pd.DataFrame):
+        if self._writer is None:
+            self._writer = xlsxwriter.Workbook(self.path, {'constant_memory': True})
+            self._sheet = self._writer.add_worksheet('Sheet1')
+            self._sheet.write_row(0, 0, [str(c) for c in self.columns])
+        # xlsxwriter cannot write NaN, so missing values become blank cells
+        values = df.astype(object).where(pd.notnull(df), None).values.tolist()
+        for i, row in enumerate(values):
+            self._sheet.write_row(self.rows + i + 1, 0, row)
+
+    def close(self):
+        if self.file_format not in self.STREAMING_FORMATS:
+            if self._chunks:
+                write_export(pd.concat(self._chunks), self.path, self.file_format)
+            self._chunks = []
+        elif self._writer is not None:
+            self._writer.close()
+        self._writer = None
+
+
+DOWNLOAD_ENCODERS = {
+    'xlsx': to_excel,
+    'csv': to_csv,
+    'csv.gz': to_csv_gz,
+    'parquet': to_parquet,
+    'feather': to_feather,
+    'geoparquet': to_geoparquet,
+    'fgb': to_flatgeobuf,
+}
+
+EXPORT_FORMATS = {
+    'xlsx': 'Excel (.xlsx)',
+    'csv': 'CSV (.csv)',
+    'csv.gz': 'Gzip CSV (.csv.gz)',
+    'parquet': 'Parquet (.parquet)',
+    'feather': 'Arrow IPC / Feather (.feather)',
+    'geoparquet': 'GeoParquet (.parquet, map data only)',
+    'fgb': 'FlatGeobuf (.fgb, map data only)',
+}
+
+EXPORT_EXTENSIONS = {'geoparquet': 'parquet'}
+
+GEO_FORMATS = ['geoparquet', 'fgb']
+
+
+def export_format(df: pd.DataFrame, file_format: str) -> str:
+    # Spatial formats need geometries, so tables without them fall back to plain Parquet
+    if file_format in GEO_FORMATS and 'geom' not in df.columns:
+        return 'parquet'
+    return file_format
+
+
+def export_file_name(file_name: str, file_format: str) -> str:
+    base = file_name
+    for ext in sorted(set(EXPORT_EXTENSIONS.get(f, f) for f in EXPORT_FORMATS), key=len, reverse=True):
+        if base.endswith('.' + ext):
+            base = base[:-len(ext) - 1]
+            break
+    return f'{base}.{EXPORT_EXTENSIONS.get(file_format, file_format)}'
+
+
+def write_export(df: pd.DataFrame, path: str, file_format: str):
+    with open(path, 'wb') as f:
+        f.write(DOWNLOAD_ENCODERS[file_format](df))
+
+
+def partition(items: list, parts: int) -> list:
+    # Contiguous shards, so concatenating the results keeps the original order
+    parts = max(1, min(parts, len(items)))
+    size, extra = divmod(len(items), parts)
+    shards, start = [], 0
+    for i in range(parts):
+        end = start + size + (i < extra)
+        shards.append(list(items[start:end]))
+        start = end
+    return shards
+
+
+def map_partitioned(func, items: list, workers: int = None, shards_per_worker: int = 2, **kwargs):
+    """Runs func(shard, **kwargs) for shards of items across worker processes.
+    in:  module-level function taking a list of items, items to shard (e.g. STATES), number of processes
+         (one per core by default, 1 runs inline), shards per process so fast shards don't leave cores idle,
+         extra arguments passed to every call
+    out: generator of each shard's result, in shard order
+    Workers are spawned rather than forked, so they don't inherit the Streamlit server's threads and open
+    connections. Each one imports the app's modules afresh, so memoized functions called inside func (e.g. the
+    per-state queries.get_county_data) neither read nor fill the server's cache; memoize the combined result instead.
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = partition(list(items), workers * shards_per_worker if workers > 1 else 1)
+    func = partial(func, **kwargs)
+    if workers == 1 or len(shards) == 1:
+        for shard in shards:
+            yield func(shard)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        yield from executor.map(func, shards)
+
+
+# Encoding runs on these threads so an interrupted rerun does not throw away a half-built file
+_download_executor = ThreadPoolExecutor(max_workers=2)
+
+# The artifact cache is shared by every session, so all reads and writes go through this lock
+_download_lock = threading.Lock()
+
+
+@st.experimental_singleton
+def _download_artifacts() -> OrderedDict:
+    # (dataset fingerprint, format) -> Future of the encoded file, shared across sessions
+    return OrderedDict()
+
+
+def download_button(label: str, df: pd.DataFrame, file_name: str, key: str = None, file_format: str = None,
+                    max_artifacts: int = 16):
+    """Shows a button that builds the file for a dataframe only when asked, then offers it for download.
+    Built files are cached by dataset fingerprint and format, so later reruns offer them straight away.
+    in:  button label, dataframe, file name, format (one of EXPORT_FORMATS; defaults to the format chosen in the
+         sidebar, then to the file name's extension)
+    """
+    if file_format is None:
+        file_format = st.session_state.get('download_format', file_name.rsplit('.', 1)[-1])
+    file_format = export_format(df, file_format)
+    file_name = export_file_name(file_name, file_format)
+    key = key if key is not None else f'download_{label}_{file_name}'
+    artifacts = _download_artifacts()
+    artifact_key = (fingerprint(df, geometry=file_format in GEO_FORMATS), file_format)
+
+    with _download_lock:
+        future = artifacts.get(artifact_key)
+        if future is not None:
+            artifacts.move_to_end(artifact_key)
+    if future is None:
+        if not st.button(label, key=key):
+            return
+        with _download_lock:
+            # Another session may have started the same file since the check above
+            future = artifacts.get(artifact_key)
+            if future is None:
+                future = _download_executor.submit(DOWNLOAD_ENCODERS[file_format], df.copy())
+                artifacts[artifact_key] = future
+                while len(artifacts) > max_artifacts:
+                    artifacts.popitem(last=False)
+
+    try:
+        with st.spinner(f'Preparing {file_name}...'):
+            data = future.result()
+    except Exception as e:
+        with _download_lock:
+            if artifacts.get(artifact_key) is future:
+                artifacts.pop(artifact_key)
+        st.error(f'{file_name} could not be prepared: {e}')
+        return
+    st.download_button(label, data, file_name=file_name, key=key + '_ready')
+
+
 def get_table_download_link(df: pd.DataFrame, file_name: str, text: str) -> str:
     """Generates a link allowing the data in a given panda dataframe to be downloaded
     in:  dataframe
@@ -24,9 +330,9 @@ def get_table_download_link(df: pd.DataFrame, file_name: str, text: str) -> str:
     return f'<a href="data:application/octet-stream;base64,{b64.decode()}" download="{file_name}.xlsx">{text}</a>'
 
 
-def output_table(df: pd.DataFrame, path: str):
+def output_table(df: pd.DataFrame, path: str, file_format: str = 'xlsx'):
     df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    df.to_excel(path)
+    write_export(df, path, export_format(df, file_format))
 
 
 def make_geojson(geo_df: pd.DataFrame, features: list) -> dict:
@@ -71,6 +377,17 @@ def convert_coordinates(row) -> list:
     return row['coordinates']
 
 
+def geom_extents(geoms: pd.Series) -> pd.DataFrame:
+    extents = []
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            extents.append((np.nan,) * len(EXTENT_COLUMNS))
+        else:
+            centroid = geom.centroid
+            extents.append(tuple(geom.bounds) + (centroid.x, centroid.y))
+    return pd.DataFrame(extents, columns=EXTENT_COLUMNS, index=geoms.index)
+
+
 def convert_geom(geo_df: pd.DataFrame, data_df: pd.DataFrame, map_features: list) -> dict:
     if 'Census Tract' not in data_df:
         data_df = data_df[['county_id'] + map_features]
@@ -1,21 +1,64 @@
 import random
+import numpy as np
 import streamlit as st
 import pandas as pd
 import geopandas as gpd
 import pydeck as pdk
 import altair as alt
-from sklearn import preprocessing as pre
 
-from constants import BREAKS, COLOR_RANGE, COLOR_VALUES
+from constants import COLOR_VALUES, EXTENT_COLUMNS, CHART_MAX_ROWS
+import analysis
+import classification
 import utils
 import queries
 
 
-def color_scale(val: float) -> list:
-    for i, b in enumerate(BREAKS):
-        if val <= b:
-            return COLOR_RANGE[i]
-    return COLOR_RANGE[i]
+def chart_data(df: pd.DataFrame, fields: list, sort_field: str = None, max_rows: int = CHART_MAX_ROWS) -> pd.DataFrame:
+    fields = list(dict.fromkeys(fields))
+    data = df[fields] if set(fields).issubset(df.columns) else df.reset_index()[fields]
+    data = data.reset_index(drop=True)
+    if len(data) <= max_rows:
+        return data
+    if sort_field:
+        # Evenly spaced rows of the sorted series keep its shape, including the minimum and maximum
+        data = data.sort_values(sort_field)
+        positions = np.unique(np.linspace(0, len(data) - 1, max_rows).round().astype(int))
+        return data.iloc[positions]
+    return data.sample(max_rows, random_state=0)
+
+
+def histogram_data(values: pd.Series, bins: int = 20) -> pd.DataFrame:
+    values = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64')
+    counts, edges = np.histogram(values[np.isfinite(values)], bins=bins)
+    return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': counts})
+
+
+def fit_view_state(geo_df: pd.DataFrame, width: int = 700, height: int = 500) -> pdk.ViewState:
+    if not set(EXTENT_COLUMNS).issubset(geo_df.columns) and 'geom' in geo_df.columns:
+        geo_df = utils.geom_extents(geo_df['geom'])
+    if not set(EXTENT_COLUMNS).issubset(geo_df.columns) or geo_df[EXTENT_COLUMNS].dropna().empty:
+        return pdk.ViewState(
+            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+
+    extents = geo_df[EXTENT_COLUMNS].dropna()
+    min_lon, max_lon = extents['min_lon'].min(), extents['max_lon'].max()
+    min_lat, max_lat = extents['min_lat'].min(), extents['max_lat'].max()
+
+    # Fit the combined extent to the viewport in web mercator coordinates
+    min_y = np.log(np.tan(np.pi / 4 + np.radians(max(min_lat, -85)) / 2))
+    max_y = np.log(np.tan(np.pi / 4 + np.radians(min(max_lat, 85)) / 2))
+    if len(extents) == 1:
+        longitude, latitude = extents['centroid_lon'].iloc[0], extents['centroid_lat'].iloc[0]
+    else:
+        longitude = (min_lon + max_lon) / 2
+        latitude = np.degrees(2 * np.arctan(np.exp((min_y + max_y) / 2)) - np.pi / 2)
+    zoom_x = np.log2(width * 360 / (256 * max(max_lon - min_lon, 1e-6)))
+    zoom_y = np.log2(height * 2 * np.pi / (256 * max(max_y - min_y, 1e-6)))
+    zoom = float(np.clip(min(zoom_x, zoom_y) - 0.25, 1, 16))
+
+    return pdk.ViewState(
+        **{"latitude": float(latitude), "longitude": float(longitude), "zoom": zoom, "maxZoom": 16, "pitch": 0,
+           "bearing": 0})
 
 
 def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_format: str = 'Raw Values',
@@ -41,51 +84,23 @@ def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_form
     geo_df_copy["coordinates"] = geojson_df["features"].apply(lambda row: row["geometry"]["coordinates"])
     geo_df_copy["name"] = geojson_df["features"].apply(lambda row: row["properties"]["name"])
     geo_df_copy[label] = geojson_df["features"].apply(lambda row: row["properties"][label])
-    scaler = pre.MinMaxScaler()
     feat_series = geo_df_copy[label]
-    feat_type = None
-
-    if feat_series.dtype == 'object':
-        try:
-            # feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            #     feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-            # normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-            color_lookup = pdk.data_utils.assign_random_colors(geo_df_copy[map_feature])
-            geo_df_copy['fill_color'] = geo_df_copy.apply(lambda row: color_lookup.get(row[map_feature]), axis=1)
-        except TypeError:
-            normalized_vals = scaler.fit_transform(
-                pd.DataFrame(feat_series)
-            )
-            colors = list(map(color_scale, normalized_vals))
-            geo_df_copy['fill_color'] = colors
-            geo_df_copy.fillna(0, inplace=True)
-            geo_df_copy = geo_df_copy.astype({label: 'float64'})
-    else:
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
-        colors = list(map(color_scale, normalized_vals))
-        geo_df_copy['fill_color'] = colors
+
+    geo_df_copy['fill_color'] = classification.fill_colors(feat_series, feature=label).tolist()
+    if feat_series.dtype != 'object':
         geo_df_copy.fillna(0, inplace=True)
         geo_df_copy = geo_df_copy.astype({label: 'float64'})
 
-
     tooltip = {"html": ""}
     if 'Census Tract' in set(geo_df_copy.columns):
         keep_cols = ['coordinates', 'name', 'fill_color', 'geom', map_feature]
         geo_df_copy.drop(list(set(geo_df_copy.columns) - set(keep_cols)), axis=1, inplace=True)
         tooltip = {"html": "<b>Tract:</b> {name} </br>" + "<b>" + str(label) + ":</b> {" + str(label) + "}"}
     elif 'County Name' in set(geo_df_copy.columns):
-        geo_df_copy.drop(['geom', 'County Name'], axis=1, inplace=True)
+        geo_df_copy.drop(['geom', 'County Name'] + EXTENT_COLUMNS, axis=1, inplace=True, errors='ignore')
         tooltip = {
             "html": "<b>County:</b> {name} </br>" + "<b>" + str(label) + ":</b> {" + str(label) + "}"}
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = fit_view_state(geo_df)
 
     polygon_layer = pdk.Layer(
         "PolygonLayer",
@@ -115,12 +130,23 @@ def make_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature: str, data_form
         print(e)
 
 
+def correlation_matrix(df: pd.DataFrame) -> analysis.CorrelationMatrix:
+    key = utils.fingerprint(df)
+    if 'correlation_matrices' not in st.session_state:
+        st.session_state['correlation_matrices'] = {}
+    matrices = st.session_state['correlation_matrices']
+    if key not in matrices:
+        if len(matrices) >= 4:
+            matrices.clear()
+        matrices[key] = analysis.CorrelationMatrix(df)
+    return matrices[key]
+
+
 def make_correlation_plot(df: pd.DataFrame, feature_cols: list):
     for feature in feature_cols:
         feat_type = 'category' if df[feature].dtype == 'object' else 'numerical'
         if feat_type == 'category':
             return
-    df = df.astype('float64')
     st.subheader('Correlation Plot')
     st.write('''
     This plot shows how individual features in the database correlate to each other. Values range from -1 to 1. 
@@ -133,7 +159,7 @@ def make_correlation_plot(df: pd.DataFrame, feature_cols: list):
     avail_cols.sort()
     cols_to_compare = st.multiselect('Columns to consider', avail_cols, feature_cols)
     if len(cols_to_compare) > 2:
-        df_corr = df[cols_to_compare].corr().stack().reset_index().rename(
+        df_corr = correlation_matrix(df).corr(cols_to_compare).stack().reset_index().rename(
             columns={0: 'correlation', 'level_0': 'variable', 'level_1': 'variable2'})
         df_corr['correlation_label'] = df_corr['correlation'].map('{:.2f}'.format)
 
@@ -177,7 +203,7 @@ def make_chart(df: pd.DataFrame, feature: str, data_format: str = 'Raw Values'):
     elif data_format == 'Per Square Mile':
         label = f"{feature} per sqmi"
         data_df[label] = data_df[feature] / df['sqmi']
-    data_df = data_df.round(3)
+    data_df = chart_data(data_df.round(3), ['County Name', label], sort_field=label)
 
     bar = alt.Chart(data_df) \
         .mark_bar() \
@@ -203,7 +229,7 @@ def make_census_chart(df: pd.DataFrame, feature: str):
                     tooltip=['county_name', feature, "tract count"]) \
             .interactive()
     else:
-        bar = alt.Chart(df) \
+        bar = alt.Chart(chart_data(df, ['Census Tract', feature], sort_field=feature)) \
             .mark_bar() \
             .encode(x='Census Tract',
                     y=feature + ':Q',
@@ -228,7 +254,7 @@ def make_scatter_plot_counties(df: pd.DataFrame, feature_1: str, feature_2: str,
         df[label_2] = df[feature_2] / df['sqmi']
     df = df.round(3)
 
-    scatter_df = df[[label_1, label_2, 'County Name', scaling_feature]]
+    scatter_df = chart_data(df, [label_1, label_2, 'County Name', scaling_feature])
     scatter = alt.Chart(scatter_df).mark_point() \
         .encode(x=label_1 + ':Q', y=label_2 + ':Q',
                 tooltip=['County Name', scaling_feature, label_1, label_2],
@@ -238,7 +264,7 @@ def make_scatter_plot_counties(df: pd.DataFrame, feature_1: str, feature_2: str,
 
 def make_scatter_plot_census_tracts(df: pd.DataFrame, feature_1: str, feature_2: str,
                                     scaling_feature: str = 'tot_population_census_2010'):
-    scatter_df = df.reset_index(drop=True)[[feature_1, feature_2, 'Census Tract', scaling_feature]]
+    scatter_df = chart_data(df, [feature_1, feature_2, 'Census Tract', scaling_feature])
     scatter = alt.Chart(scatter_df).mark_point() \
         .encode(x=feature_1 + ':Q', y=feature_2 + ':Q',
                 tooltip=['Census Tract', scaling_feature, feature_1, feature_2],
@@ -265,29 +291,12 @@ def make_equity_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature:
     for header in EQUITY_MAP_HEADERS:
         geo_df_copy[header] = geojson_df["features"].apply(lambda row: row["properties"][header])
 
-    scaler = pre.MinMaxScaler()
     feat_series = geo_df_copy[map_feature]
-    feat_type = None
-    if feat_series.dtype == 'object':
-        feat_type = 'category'
-        feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-        normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-    else:
-        feat_type = 'numerical'
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
-
-    colors = list(map(color_scale, normalized_vals))
-    geo_df_copy['fill_color'] = colors
+    feat_type = 'category' if feat_series.dtype == 'object' else 'numerical'
+    geo_df_copy['fill_color'] = classification.fill_colors(
+        feat_series, feature=map_feature, override={'Not selected as an Equity Geography': [0, 0, 0, 25]}).tolist()
     geo_df_copy.fillna(0, inplace=True)
 
-    for x in range(len(geo_df_copy.index)):
-        geo_df_copy['fill_color'].iloc[x] = [0, 0, 0, 25] if df[map_feature].iloc[
-                                                                 x] == 'Not selected as an Equity Geography' else \
-            geo_df_copy['fill_color'].iloc[x]
-
     tooltip = {"html": ""}
     if 'Census Tract' in set(geo_df_copy.columns):
         keep_cols = ['coordinates', 'name', 'fill_color', 'geom', map_feature]
@@ -304,17 +313,11 @@ def make_equity_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_feature:
             }
 
     elif 'County Name' in set(geo_df_copy.columns):
-        geo_df_copy.drop(['geom', 'County Name'], axis=1, inplace=True)
+        geo_df_copy.drop(['geom', 'County Name'] + EXTENT_COLUMNS, axis=1, inplace=True, errors='ignore')
         tooltip = {
             "html": "<b>County:</b> {name} </br>" + "<b>" + str(map_feature) + ":</b> {" + str(map_feature) + "}"
         }
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = fit_view_state(geo_df)
 
     if feat_type == 'numerical':
         geo_df_copy = geo_df_copy.astype({map_feature: 'float64'})
@@ -356,22 +359,9 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
     for header in list(set(df.columns)-set(subset)):
         geo_df_copy[header] = geojson_df["features"].apply(lambda row: row["properties"][header])
 
-    scaler = pre.MinMaxScaler()
     feat_series = geo_df_copy[map_feature]
-    feat_type = None
-    if feat_series.dtype == 'object':
-        feat_type = 'category'
-        feat_dict = {k: (i % 10) / 10 for i, k in enumerate(
-            feat_series.unique())}  # max 10 categories, following from constants.BREAK, enumerated rather than encoded
-        normalized_vals = feat_series.apply(lambda x: feat_dict[x])  # getting normalized vals, manually.
-    else:
-        feat_type = 'numerical'
-        normalized_vals = scaler.fit_transform(
-            pd.DataFrame(feat_series)
-        )
-
-    colors = list(map(color_scale, normalized_vals))
-    geo_df_copy['fill_color'] = colors
+    feat_type = 'category' if feat_series.dtype == 'object' else 'numerical'
+    geo_df_copy['fill_color'] = classification.fill_colors(feat_series, feature=map_feature).tolist()
     geo_df_copy.fillna(0, inplace=True)
 
     tooltip = {"html": ""}
@@ -389,13 +379,7 @@ def make_transport_census_map(geo_df: pd.DataFrame, df: pd.DataFrame, map_featur
                         "<b>" + str(map_feature) + ":</b> {" + str(map_feature) + "}"+ queries.TABLE_UNITS[map_feature]+" </br>"
             }
 
-    if len(geo_df_copy['coordinates'][0][0][0]) > 0:
-        view_state = pdk.ViewState(
-            **{"latitude": geo_df_copy['coordinates'][0][0][0][1], "longitude": geo_df_copy['coordinates'][0][0][0][0],
-               "zoom": 5, "maxZoom": 16, "pitch": 0, "bearing": 0})
-    else:
-        view_state = pdk.ViewState(
-            **{"latitude": 36, "longitude": -95, "zoom": 3, "maxZoom": 16, "pitch": 0, "bearing": 0})
+    view_state = fit_view_state(geo_df)
 
     if feat_type == 'numerical':
         geo_df_copy = geo_df_copy.astype({map_feature: 'float64'})
@@ -474,7 +458,7 @@ def make_equity_census_chart(df: pd.DataFrame, threshold: dict, average: dict, f
                     tooltip=['county_name', feature, "tract count"]) \
             .interactive()
     else:
-        bar = alt.Chart(df) \
+        bar = alt.Chart(chart_data(df, ['Census Tract', feature], sort_field=feature)) \
             .mark_bar() \
             .encode(x=alt.X('Census Tract:O', axis=alt.Axis(labels=False), title='Census Tract Distribution', sort='y'),
                     y=alt.Y(feature + ':Q', title=feature),
@@ -517,7 +501,7 @@ def make_transport_census_chart(df: pd.DataFrame, average: dict, feature: str):
                     tooltip=['county_name', feature, "tract count"]) \
             .interactive()
     else:
-        bar = alt.Chart(df) \
+        bar = alt.Chart(chart_data(df, ['Census Tract', feature], sort_field=feature)) \
             .mark_bar() \
             .encode(x=alt.X('Census Tract:O', axis=alt.Axis(labels=False), title='Census Tracts', sort='y'),
                     y=alt.Y(feature + ':Q', title=feature),
@@ -575,15 +559,39 @@ def make_stacked(df: pd.DataFrame):
     st.altair_chart(bar, use_container_width=True)
 
 
+def make_cost_scenarios_chart(df: pd.DataFrame):
+    line = alt.Chart(df) \
+        .mark_line(point=True) \
+        .encode(x=alt.X('Percent Burdened:Q', title='Percent of Burdened Population to Support'),
+                y=alt.Y('total_cost:Q', title='Total Cost'),
+                color=alt.Color('Location:N'),
+                strokeDash=alt.StrokeDash('Rent Type:N'),
+                tooltip=['Location', 'Rent Type', 'Percent Burdened', alt.Tooltip('total_cost:Q', format=',.0f')]) \
+        .interactive()
+
+    st.altair_chart(line, use_container_width=True)
+
+
+def make_trend_chart(df: pd.DataFrame, feature: str, label: str):
+    line = alt.Chart(df) \
+        .mark_line(point=True) \
+        .encode(x=alt.X('date:T', title='Date'),
+                y=alt.Y(feature + ':Q', title=feature),
+                color=alt.Color(label + ':N'),
+                tooltip=[label, alt.Tooltip('date:T'), feature]) \
+        .interactive()
+
+    st.altair_chart(line, use_container_width=True)
+
+
 def make_histogram(df: pd.DataFrame, feature: str):
-    base = alt.Chart(df)
-    hist = base.mark_bar().encode(
-        x=alt.X(feature + ':Q', bin=alt.BinParams()
-                ),
-        y='count()'
+    hist = alt.Chart(histogram_data(df[feature])).mark_bar().encode(
+        x=alt.X('bin_start:Q', title=feature),
+        x2='bin_end:Q',
+        y=alt.Y('count:Q', title='Count of Records')
     )
-    median_line = base.mark_rule().encode(
-        x=alt.X('mean(' + feature + '):Q', title=feature),
+    median_line = alt.Chart(pd.DataFrame([{'mean': df[feature].mean()}])).mark_rule().encode(
+        x='mean:Q',
         size=alt.value(5)
     )
     st.altair_chart(hist + median_line, use_container_width=True)
@@ -600,34 +608,25 @@ def make_simple_chart(df: pd.DataFrame, feature: str):
 
 
 def make_transit_layers(tract_df: pd.DataFrame, pickable: bool = True):
-    tracts = tract_df['Census Tract'].to_list()
-    tracts_str = str(tuple(tracts)).replace(',)', ')')
-
-    NTM_shapes = queries.get_transit_shapes_geoms(
-        columns=['route_desc', 'route_type_text', 'length', 'geom', 'tract_id', 'route_long_name'],
-        where=f" tract_id IN {tracts_str}")
-
-    tolerance = 0.0000750
-    NTM_shapes['geom'] = NTM_shapes['geom'].apply(lambda x: x.simplify(tolerance, preserve_topology=False))
-
-    NTM_stops = queries.get_transit_stops_geoms(columns=['stop_name', 'stop_lat', 'stop_lon', 'geom'],
-                                                where=f" tract_id IN {tracts_str}")
-
-    NTM_shapes.drop_duplicates(subset=['geom'])
-    NTM_stops.drop_duplicates(subset=['geom'])
+    if 'state_name' in tract_df.columns:
+        states = tract_df['state_name']
+    else:
+        states = tract_df.reset_index()['State']
+    shape_frames, stop_frames = [], []
+    for state, tracts in tract_df.groupby(states.to_numpy())['Census Tract']:
+        state_shapes, state_stops = queries.transit_for_tracts(state, tracts.to_list())
+        shape_frames.append(state_shapes)
+        stop_frames.append(state_stops)
+    NTM_shapes = pd.concat(shape_frames) if shape_frames else pd.DataFrame()
+    NTM_stops = pd.concat(stop_frames) if stop_frames else pd.DataFrame()
 
     if NTM_shapes.empty:
         st.write("Transit lines have not been identified for Equity Geographies in this region.")
         line_layer = None
     else:
-        NTM_shapes['path'] = NTM_shapes['geom'].apply(utils.coord_extractor)
-        NTM_shapes.fillna("N/A", inplace=True)
-
-        route_colors = {}
-        for count, value in enumerate(NTM_shapes['route_type_text'].unique()):
-            route_colors[value] = COLOR_VALUES[count]
-        NTM_shapes['color'] = NTM_shapes['route_type_text'].apply(lambda x: route_colors[x])
-        NTM_shapes['alt_color'] = NTM_shapes['color'].apply(lambda x: "#%02x%02x%02x" % (x[0], x[1], x[2]))
+        NTM_shapes = NTM_shapes[['route_type_text', 'route_long_name', 'path']].copy()
+        route_types, _ = pd.factorize(NTM_shapes['route_type_text'])
+        NTM_shapes['color'] = np.array(COLOR_VALUES)[route_types % len(COLOR_VALUES)].tolist()
 
         # REMOVED LEGEND BECAUSE IT LOOKED BUSY
         # bar = alt.Chart(